@@ -0,0 +1,81 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Importing the controller sets up the log file and creates the sqlite db under BASE_DIR, so point it at a temp
+# dir (removed at exit) instead of the repo
+base_dir = tempfile.TemporaryDirectory(prefix='bench_controller_')
+os.environ['TRADING_BOT_BASE_DIR'] = base_dir.name
+
+from trading_bot.controller import Controller  # noqa: E402
+
+"""
+Trade manager loop throughput: the old per iteration ThreadPoolExecutor against the session long pool and the inline
+mode of Controller.run. Managers are stand-ins that do a little work per call, like a manager with nothing to do.
+
+python -m bench.bench_controller (from the repo root)
+"""
+
+DURATION = 2  # Seconds per case
+MANAGER_COUNTS = [1, 2, 5, 20, 50]
+
+
+class FakeManager:
+    trade_ended = False
+    time_based_exit = False
+
+    def __init__(self, work=200):
+        self.work = work
+
+    def is_woken_by(self, events):
+        return True
+
+    def trade(self):
+        sum(range(self.work))
+        return None
+
+
+class PerIterationPoolController(Controller):
+    """
+    Controller.run as it was before, a new pool every iteration
+    """
+
+    def run(self, events, heartbeat_due, new_managers=()):
+        with ThreadPoolExecutor() as executor:
+            res = executor.map(self.run_instance, self.trade_managers)
+        return [r for r in res if r is not None]
+
+
+def pool_controller(max_workers):
+    controller = Controller(None, None, max_workers=max_workers)
+    controller.INLINE_MANAGERS = 0
+    return controller
+
+
+def iterations_per_second(controller):
+    count = 0
+    end = time.perf_counter() + DURATION
+    while time.perf_counter() < end:
+        controller.run(events=set(), heartbeat_due=True)
+        count += 1
+    controller.close()
+    return count / DURATION
+
+
+def main():
+    cases = [('per iteration pool', lambda: PerIterationPoolController(None, None)),
+             ('persistent pool', lambda: pool_controller(max_workers=4)),
+             ('inline', lambda: Controller(None, None, max_workers=0))]
+    print(f'{"managers":>8} ' + ' '.join(f'{name:>20}' for name, _ in cases) + '   (loop iterations/s)')
+    for count in MANAGER_COUNTS:
+        results = []
+        for name, make in cases:
+            controller = make()
+            controller.trade_managers = [FakeManager() for _ in range(count)]
+            results.append(iterations_per_second(controller))
+        print(f'{count:>8} ' + ' '.join(f'{r:>20.0f}' for r in results))
+
+
+if __name__ == '__main__':
+    main()
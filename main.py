@@ -31,6 +31,40 @@ total_loss_amount = 600   # If this much amount lost then stop trading for the d
 day_down_percent = 1  # If underlying is down from day's open by more than this much percent then ignore trade
 stop_loss = 20   # Stop loss percent to set stop loss at the start
 tighter_stop_loss = 7  # Stop loss percent to set stop loss after price moves up more than 20 percent
+heartbeat = 1  # Seconds between time based checks (trade end time, end time) when no new bar/tick/order arrives
+
+# Choices: STP, TRAIL.
+# STP cancels and re-places a stop order every time the stop is trailed up,
+# TRAIL places a trailing stop order that IB moves up by itself (modified once when the tighter stop loss kicks in)
+sl_order_type = 'STP'
+
+# Choices: MKT, BRACKET.
+# MKT sends a market entry and places the SL order once the fill is seen,
+# BRACKET sends the SL order together with the market entry as its child so it's live as soon as the entry fills
+entry_order_type = 'MKT'
+
+# Trade updates are written to the db by a background thread in batches so trading never waits on the disk,
+# True commits every update before trading goes on (nothing is lost if the process is killed, trading waits on the disk)
+crash_safe_journal = False
+
+# Number of strikes from the nearest one upwards kept validated in the background while waiting for a signal,
+# 0 to disable. prefetch_market_data also keeps market data streaming for the strike a signal would pick
+prefetch_strikes = 3
+prefetch_market_data = False
+
+# Threads running the trade managers with new ticks/order updates when more than 10 of them are woken at once,
+# 0 to always run them one by one on the main loop
+max_workers = 4
+
+market_data_lines = 100  # Market data lines of the IB account, idle option lines are cancelled to stay within it
+
+bootstrap_workers = 8  # Symbols set up at the same time at startup (contract id, option chain and bars requests)
+
+# Choices: historical, tick_by_tick, realtime_bars.
+# historical keeps the bars up to date with the bar updates TWS pushes for the historical data request,
+# tick_by_tick and realtime_bars (5 second bars) build the bars locally from the live data so signals don't wait
+# for the next bar update. Tick by tick data is limited to a few symbols at a time by IB (depends on the account)
+bar_source = 'historical'
 
 if __name__ == '__main__':
     kwargs = {i: j for i, j in locals().items() if not i.startswith('__')}
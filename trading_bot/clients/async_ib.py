@@ -0,0 +1,144 @@
+import asyncio
+from collections import defaultdict
+
+from trading_bot.clients.events import EventDispatcher
+from trading_bot.clients.pending import IBRequestError
+
+
+class AsyncIBapi:
+    """
+    asyncio facade over a connected IBapi. The EWrapper callbacks still run on the IB reader thread; their
+    request futures and events are handed over to the event loop, so coroutines can await requests and iterate
+    bar updates, option ticks and order fills without threads or polling.
+
+    Must be created from a coroutine running on the loop that will use it.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.loop = asyncio.get_running_loop()
+        self._waiters = defaultdict(set)
+        client.events.subscribe(self._on_event)
+
+    def close(self):
+        self.client.events.unsubscribe(self._on_event)
+
+    def _on_event(self, kind, key):
+        # Reader thread
+        if (kind, key) in self._waiters:
+            self.loop.call_soon_threadsafe(self._wake, kind, key)
+
+    def _wake(self, kind, key):
+        for event in self._waiters.get((kind, key), ()):
+            event.set()
+
+    def _watch(self, *keys):
+        event = asyncio.Event()
+        for key in keys:
+            self._waiters[key].add(event)
+        return event
+
+    def _unwatch(self, event, *keys):
+        for key in keys:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[key]
+
+    def _next_id(self):
+        return self.client.ids.next_request_id()
+
+    async def _request(self, reqId, send, timeout):
+        future = self.client.pending.register(reqId)
+        send()
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self.client.pending.discard(reqId)
+            raise
+
+    async def req_contract_details(self, contract, timeout=15):
+        reqId = self._next_id()
+        return await self._request(reqId, lambda: self.client.reqContractDetails(reqId, contract), timeout)
+
+    async def req_sec_def_opt_params(self, ticker, sec_type, con_id, local_symbol, timeout=15):
+        reqId = self._next_id()
+        self.client.sec_id_to_local_symbol[reqId] = local_symbol
+        await self._request(reqId, lambda: self.client.reqSecDefOptParams(
+            reqId=reqId, underlyingSymbol=ticker, futFopExchange="", underlyingSecType=sec_type,
+            underlyingConId=con_id), timeout)
+        return self.client.contract_chain.get(ticker)
+
+    async def req_historical(self, contract, duration, bar_size, what_to_show='TRADES', use_rth=1,
+                             keep_up_to_date=True, timeout=60):
+        """
+        Request historical bars, returns (reqId, BarStore) once the backfill is loaded; with keep_up_to_date the
+        store keeps updating and bar_updates(reqId) follows it
+        """
+        reqId = self._next_id()
+        store = await self._request(reqId, lambda: self.client.reqHistoricalData(
+            reqId=reqId, contract=contract, durationStr=duration, barSizeSetting=bar_size, whatToShow=what_to_show,
+            useRTH=use_rth, endDateTime='', formatDate=1, keepUpToDate=keep_up_to_date, chartOptions=[]), timeout)
+        return reqId, store
+
+    async def bar_updates(self, reqId):
+        """
+        Latest bar (datetime, open, high, low, close, volume) after each update; updates arriving while the
+        consumer is busy are collapsed into the newest one
+        """
+        key = (EventDispatcher.BAR, reqId)
+        event = self._watch(key)
+        try:
+            while True:
+                await event.wait()
+                event.clear()
+                store = self.client.bar_stores.get(reqId)
+                if store is None or not len(store):
+                    continue
+                i = len(store) - 1
+                yield store.datetime_at(i), store.open[i], store.high[i], store.low[i], store.close[i], store.volume[i]
+        finally:
+            self._unwatch(event, key)
+
+    async def option_ticks(self, contract):
+        """
+        Subscribe to option market data and yield the latest option price on every new computation tick; the
+        shared market data line is released when the consumer stops iterating
+        """
+        reqId = self.client.market_data.acquire(contract)
+        key = (EventDispatcher.TICK, reqId)
+        event = self._watch(key)
+        if reqId in self.client.ticks:
+            event.set()
+        try:
+            while True:
+                await event.wait()
+                event.clear()
+                yield self.client.ticks.get(reqId).value
+        finally:
+            self._unwatch(event, key)
+            self.client.market_data.release(reqId)
+
+    async def order_filled(self, orderId, qty, timeout=None):
+        """
+        Wait until executions for orderId add up to qty, returns the execution; raises IBRequestError if the
+        order is cancelled or rejected first
+        """
+        return await asyncio.wait_for(self._order_filled(orderId, qty), timeout)
+
+    async def _order_filled(self, orderId, qty):
+        keys = (EventDispatcher.EXECUTION, orderId), (EventDispatcher.ORDER, orderId)
+        event = self._watch(*keys)
+        try:
+            while True:
+                exec_order = self.client.executions.get(orderId)
+                if exec_order is not None and exec_order['exec_qty'] == qty:
+                    return exec_order
+                order = self.client.order_status.get(orderId)
+                if order is not None and order['status'] in ['Cancelled', 'Inactive']:
+                    raise IBRequestError(orderId, None, order['status'])
+                await event.wait()
+                event.clear()
+        finally:
+            self._unwatch(event, *keys)
@@ -0,0 +1,69 @@
+import math
+import os
+import time
+
+import numpy as np
+
+from trading_bot.clients.bar_store import BarStore
+from trading_bot.settings import CACHE_DIR, logger
+
+DURATION_SECONDS = {'S': 1, 'D': 86400, 'W': 7 * 86400, 'M': 31 * 86400, 'Y': 365 * 86400}
+
+
+def duration_seconds(duration):
+    """
+    Seconds covered by an IB duration string like '1 M', months and years rounded up
+    """
+    count, unit = duration.split()
+    return int(count) * DURATION_SECONDS[unit.upper()]
+
+
+def tail_duration(last_ts, now=None):
+    """
+    IB duration string reaching back to the epoch second last_ts, the last cached bar is requested again since
+    it may have been saved while still in progress
+    """
+    seconds = int((now or time.time()) - last_ts) + 60
+    if seconds <= 86400:
+        return f'{seconds} S'
+    return f'{math.ceil(seconds / 86400)} D'
+
+
+class BarCache:
+    """
+    Historical bars on disk, one npz file of BarStore columns per symbol/bar size/data type/rth setting
+    """
+
+    def __init__(self, root=CACHE_DIR / 'bars'):
+        self.root = root
+
+    def path(self, symbol, bar_size, what_to_show, use_rth):
+        name = f'{symbol}_{bar_size}_{what_to_show}_{"rth" if use_rth else "all"}'.replace(' ', '_')
+        return self.root / f'{name}.npz'
+
+    def load(self, path, duration, now=None):
+        """
+        Cached bars within the duration window ending now, None when there's nothing usable
+        """
+        if not path.exists():
+            return None
+        try:
+            with np.load(path) as data:
+                columns = {k: data[k] for k in ('ts',) + BarStore.FIELDS}
+        except Exception as e:
+            logger.exception(e)
+            return None
+        keep = columns['ts'] >= (now or time.time()) - duration_seconds(duration)
+        if not keep.any():
+            return None
+        return BarStore.from_arrays(*(columns[k][keep] for k in ('ts',) + BarStore.FIELDS))
+
+    def save(self, path, store):
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix('.tmp.npz')
+            np.savez(tmp, ts=store.ts, **{field: getattr(store, field) for field in BarStore.FIELDS})
+            # Replaced in one go so a crash mid write never leaves a truncated cache behind
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.exception(e)
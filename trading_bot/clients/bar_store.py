@@ -0,0 +1,124 @@
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+from trading_bot.settings import TZ
+
+
+class BarStore:
+    """
+    Columnar OHLCV storage for one bar stream: one preallocated array per field, doubled when full. Timestamps
+    are epoch seconds. A bar with the same timestamp as the last one overwrites it in place (IB resends the bar in
+    progress), older bars are ignored.
+
+    The array properties are zero-copy views over the filled rows; a view taken before the store grows keeps
+    pointing at the old buffer, so take fresh ones on every evaluation instead of holding on to them.
+    """
+    FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, capacity=1024, tz=TZ):
+        self.tz = tz
+        self.size = 0
+        self._ts = np.empty(capacity, dtype=np.int64)
+        self._fields = {field: np.empty(capacity, dtype=np.float64) for field in self.FIELDS}
+
+    @classmethod
+    def from_arrays(cls, ts, open, high, low, close, volume, tz=TZ):
+        """
+        Build a store from a whole backfill at once, `ts` being sorted epoch seconds
+        """
+        size = len(ts)
+        store = cls(capacity=max(1024, 2 * size), tz=tz)
+        store._ts[:size] = ts
+        for field, values in zip(cls.FIELDS, (open, high, low, close, volume)):
+            store._fields[field][:size] = values
+        store.size = size
+        return store
+
+    def __len__(self):
+        return self.size
+
+    def append(self, dt, open, high, low, close, volume):
+        ts = int(dt.timestamp())
+        row = self.size
+        if row:
+            last_ts = self._ts[row - 1]
+            if ts < last_ts:
+                return False
+            if ts == last_ts:
+                row -= 1
+        if row == len(self._ts):
+            self._grow()
+
+        fields = self._fields
+        fields['open'][row] = open
+        fields['high'][row] = high
+        fields['low'][row] = low
+        fields['close'][row] = close
+        fields['volume'][row] = volume
+        self._ts[row] = ts
+        # Size is bumped last so readers on other threads never see a row before it is written
+        self.size = max(self.size, row + 1)
+        return True
+
+    def _grow(self):
+        capacity = 2 * len(self._ts)
+        self._ts = self._resized(self._ts, capacity)
+        self._fields = {field: self._resized(values, capacity) for field, values in self._fields.items()}
+
+    def _resized(self, values, capacity):
+        resized = np.empty(capacity, dtype=values.dtype)
+        resized[:self.size] = values[:self.size]
+        return resized
+
+    @property
+    def ts(self):
+        return self._ts[:self.size]
+
+    @property
+    def open(self):
+        return self._fields['open'][:self.size]
+
+    @property
+    def high(self):
+        return self._fields['high'][:self.size]
+
+    @property
+    def low(self):
+        return self._fields['low'][:self.size]
+
+    @property
+    def close(self):
+        return self._fields['close'][:self.size]
+
+    @property
+    def volume(self):
+        return self._fields['volume'][:self.size]
+
+    def datetime_at(self, i):
+        return datetime.fromtimestamp(int(self.ts[i]), tz=self.tz)
+
+    def rows(self):
+        """
+        Iterate (datetime, open, high, low, close, volume) over the stored bars
+        """
+        for i in range(self.size):
+            yield (self.datetime_at(i), self._fields['open'][i], self._fields['high'][i], self._fields['low'][i],
+                   self._fields['close'][i], self._fields['volume'][i])
+
+    def session_open(self, date):
+        start = int(self.tz.localize(datetime.combine(date, time())).timestamp())
+        end = int(self.tz.localize(datetime.combine(date + timedelta(days=1), time())).timestamp())
+        ts = self.ts
+        i = int(np.searchsorted(ts, start))
+        if i < len(ts) and ts[i] < end:
+            return float(self.open[i])
+        return None
+
+    def frame(self):
+        """
+        DataFrame over the stored bars; the columns share memory with the store
+        """
+        index = pd.to_datetime(self.ts, unit='s', utc=True).tz_convert(self.tz)
+        return pd.DataFrame({field: getattr(self, field) for field in self.FIELDS}, index=index, copy=False)
@@ -0,0 +1,129 @@
+import atexit
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from trading_bot.settings import CACHE_DIR, TZ, logger
+
+
+class ContractCache:
+    """
+    conIds, option chains and validated option contracts kept on disk between sessions. conIds live for a week,
+    chains till the end of the day (new expiries get listed daily) and validated options till they expire.
+
+    Updates only mark the cache dirty, a background thread writes the file every FLUSH_INTERVAL seconds and close()
+    writes what's left, so strike validation never waits on the disk
+    """
+    CON_ID_TTL = 7 * 86400
+    FLUSH_INTERVAL = 5
+
+    def __init__(self, path=CACHE_DIR / 'contracts.json', flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.data = self._read()
+        self.dirty = False
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='contract-cache', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _read(self):
+        data = {'con_ids': {}, 'chains': {}}
+        try:
+            if self.path.exists():
+                with open(self.path) as f:
+                    data.update(json.load(f))
+        except Exception as e:
+            logger.exception(e)
+        now = time.time()
+        for section in data.values():
+            for key in [k for k, v in section.items() if v['expires'] <= now]:
+                del section[key]
+        return data
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            text = json.dumps(self.data)
+            self.dirty = False
+        self._write(text)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+
+    def _write(self, text):
+        with self._write_lock:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self.path.with_suffix('.tmp')
+                with open(tmp, 'w') as f:
+                    f.write(text)
+                os.replace(tmp, self.path)
+            except Exception as e:
+                logger.exception(e)
+
+    @staticmethod
+    def contract_key(contract):
+        key = f'{contract.symbol} {contract.secType} {contract.currency} {contract.exchange}'
+        if contract.secType == 'OPT':
+            key += f' {contract.lastTradeDateOrContractMonth} {contract.right} {float(contract.strike)}'
+        return key
+
+    @staticmethod
+    def option_expires(contract):
+        expiry = datetime.strptime(str(contract.lastTradeDateOrContractMonth)[:8], '%Y%m%d')
+        return TZ.localize(expiry + timedelta(days=1)).timestamp()
+
+    @staticmethod
+    def end_of_day():
+        tomorrow = datetime.now(tz=TZ).date() + timedelta(days=1)
+        return TZ.localize(datetime(tomorrow.year, tomorrow.month, tomorrow.day)).timestamp()
+
+    def _get(self, section, key):
+        with self._lock:
+            entry = self.data[section].get(key)
+            if entry is None:
+                return None
+            if entry['expires'] <= time.time():
+                del self.data[section][key]
+                return None
+            return entry['value']
+
+    def _set(self, section, key, value, expires):
+        with self._lock:
+            self.data[section][key] = {'value': value, 'expires': expires}
+            self.dirty = True
+
+    def get_con_id(self, contract):
+        return self._get('con_ids', self.contract_key(contract))
+
+    def set_con_id(self, contract, con_id):
+        if contract.secType == 'OPT':
+            expires = self.option_expires(contract)
+        else:
+            expires = time.time() + self.CON_ID_TTL
+        self._set('con_ids', self.contract_key(contract), con_id, expires)
+
+    def get_chain(self, ticker):
+        """
+        {expiry: strikes} of the ticker without the expiries already gone, None if not cached
+        """
+        chain = self._get('chains', ticker)
+        if chain is None:
+            return None
+        today = datetime.now(tz=TZ).strftime('%Y%m%d')
+        return {expiry: strikes for expiry, strikes in chain.items() if expiry >= today} or None
+
+    def set_chain(self, ticker, chain):
+        self._set('chains', ticker, chain, self.end_of_day())
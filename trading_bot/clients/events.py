@@ -0,0 +1,43 @@
+import threading
+
+
+class EventDispatcher:
+    """
+    Collects (kind, key) events published by IBapi callbacks on the reader thread, e.g. ('bar', reqId) or
+    ('order', orderId), until the controller collects them with wait(). Repeated events for the same key
+    between two waits are collapsed into one. Listeners registered with subscribe() are also called with every
+    event, on the publishing thread.
+    """
+    BAR = 'bar'
+    CHAIN = 'chain'
+    TICK = 'tick'
+    ORDER = 'order'
+    EXECUTION = 'execution'
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = set()
+        self._listeners = []
+
+    def subscribe(self, listener):
+        self._listeners = self._listeners + [listener]
+
+    def unsubscribe(self, listener):
+        self._listeners = [i for i in self._listeners if i is not listener]
+
+    def publish(self, kind, key):
+        with self._condition:
+            self._pending.add((kind, key))
+            self._condition.notify_all()
+        for listener in self._listeners:
+            listener(kind, key)
+
+    def wait(self, timeout=None):
+        """
+        Block until at least one event is pending or timeout expires, return and clear the pending events
+        """
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            events, self._pending = self._pending, set()
+        return events
@@ -1,34 +1,55 @@
-import time
+import threading
 from collections import defaultdict
+from concurrent import futures
+from functools import partial
 
-import pandas as pd
-import pytz
-from dateutil.parser import parse
+import numpy as np
 
 from ibapi.client import EClient
 from ibapi.contract import Contract
 from ibapi.decoder import TagValue
 from ibapi.order import Order
 from ibapi.wrapper import EWrapper
-from trading_bot.settings import TZ, logger
+from trading_bot.clients.bar_cache import BarCache, tail_duration
+from trading_bot.clients.bar_store import BarStore
+from trading_bot.clients.contract_cache import ContractCache
+from trading_bot.clients.option_chain import OptionChain
+from trading_bot.clients.pacing import OutboundScheduler, PRIORITY, DATA, historical_data_class
+from trading_bot.clients.events import EventDispatcher
+from trading_bot.clients.ids import IdAllocator
+from trading_bot.clients.live_bars import BarAggregator
+from trading_bot.clients.market_data import MarketDataLines
+from trading_bot.clients.ib_time import parse_ib_time, parse_ib_times, to_epoch_seconds
+from trading_bot.clients.pending import IBRequestError, PendingRequests
+from trading_bot.clients.ticks import TickMailbox
+from trading_bot.indicators.stdev import RollingStd
+from trading_bot.indicators.vwap import SessionVwap
+from trading_bot.settings import logger
 
 
 class IBapi(EWrapper, EClient):
     def __init__(self):
         EClient.__init__(self, self)
-        self.orders = []
-        self.exec_orders = []
+        self.order_status = {}
+        self.executions = {}
         self.positions = []
         self.total_amount = 0
         self.data = defaultdict(list)
         self.contract_data = dict()
-        self.options_data = defaultdict(dict)
         self.subscribed_symbols = dict()
         self.extended_hours_data = True
         self.time_frame = '1 min'
         self.option_computations = dict()
         self.ticks_data = defaultdict()
-        self.data_frames = defaultdict(pd.DataFrame)
+        self.bar_stores = {}
+        self.bar_cache = BarCache()
+        self.cached_bars = {}
+        self.vwaps = {}
+        self.stdevs = {}
+        # Bars built locally from tick-by-tick trades or real time bars: bars reqId -> BarAggregator and
+        # stream reqId -> (bars reqId, source)
+        self.live_bars = {}
+        self.live_bar_streams = {}
 
         self.expiries = {}
         self.variables = {}
@@ -42,65 +63,156 @@ class IBapi(EWrapper, EClient):
         self.ticker_to_conId = {}
         self.tickers_to_local_symbol = {}
         self.contract_chain = {}
+        self.option_chains = {}
+        self.contract_cache = ContractCache()
+        self.invalid_contracts = set()
+        # contract key -> Future of the conId lookup in flight, so concurrent lookups of a contract share one request
+        self.con_id_lookups = {}
+        self._con_id_lock = threading.Lock()
         self.sec_id_to_local_symbol = {}
-        self.secContract_details_end = list()
+        self.secContract_details_end = set()
 
-        self.error_ids = list()
-        self.contract_details_end = list()
+        self.pending = PendingRequests()
+        self.contract_details = defaultdict(list)
         self.ltp_contract_started = set()
-        self.reqId_to_ltp = {}
+        self.ticks = TickMailbox()
+        self.events = EventDispatcher()
+        self.ids = IdAllocator()
+        self.outbound = OutboundScheduler()
+        self.market_data = MarketDataLines(self)
+
+    # Outgoing requests go through the pacing scheduler, orders and cancels ahead of data requests
+    def placeOrder(self, orderId, *args, **kwargs):
+        # Modifies of an order still waiting to be sent replace it
+        self.outbound.submit(PRIORITY, 'order', partial(EClient.placeOrder, self, orderId, *args, **kwargs),
+                             key=('placeOrder', orderId))
+
+    def cancelOrder(self, *args, **kwargs):
+        self.outbound.submit(PRIORITY, 'order', partial(EClient.cancelOrder, self, *args, **kwargs))
+
+    def reqMktData(self, *args, **kwargs):
+        self.outbound.submit(DATA, 'market_data', partial(EClient.reqMktData, self, *args, **kwargs))
+
+    def cancelMktData(self, *args, **kwargs):
+        self.outbound.submit(DATA, 'market_data', partial(EClient.cancelMktData, self, *args, **kwargs))
+
+    def reqHistoricalData(self, reqId, contract, endDateTime, durationStr, barSizeSetting, *args, **kwargs):
+        self.outbound.submit(DATA, historical_data_class(barSizeSetting),
+                             partial(EClient.reqHistoricalData, self, reqId, contract, endDateTime, durationStr,
+                                     barSizeSetting, *args, **kwargs))
+
+    def reqTickByTickData(self, *args, **kwargs):
+        self.outbound.submit(DATA, 'market_data', partial(EClient.reqTickByTickData, self, *args, **kwargs))
+
+    def cancelTickByTickData(self, *args, **kwargs):
+        self.outbound.submit(DATA, 'market_data', partial(EClient.cancelTickByTickData, self, *args, **kwargs))
+
+    def reqRealTimeBars(self, *args, **kwargs):
+        self.outbound.submit(DATA, 'market_data', partial(EClient.reqRealTimeBars, self, *args, **kwargs))
+
+    def cancelRealTimeBars(self, *args, **kwargs):
+        self.outbound.submit(DATA, 'market_data', partial(EClient.cancelRealTimeBars, self, *args, **kwargs))
+
+    def reqContractDetails(self, *args, **kwargs):
+        self.outbound.submit(DATA, 'contract', partial(EClient.reqContractDetails, self, *args, **kwargs))
+
+    def reqSecDefOptParams(self, *args, **kwargs):
+        self.outbound.submit(DATA, 'contract', partial(EClient.reqSecDefOptParams, self, *args, **kwargs))
+
+    def reqAccountSummary(self, *args, **kwargs):
+        self.outbound.submit(DATA, 'account', partial(EClient.reqAccountSummary, self, *args, **kwargs))
+
+    def disconnect(self):
+        self.outbound.close()
+        logger.debug(f'Outbound message stats: {self.outbound.metrics()}')
+        logger.debug(f'Tick to decision age stats: {self.ticks.metrics()}')
+        self.contract_cache.close()
+        super().disconnect()
 
     def nextValidId(self, orderId: int):
         super().nextValidId(orderId)
-        self.nextorderId = orderId
-        logger.info(f'The next valid order id is: {self.nextorderId}')
+        self.ids.set_next_order_id(orderId)
+        logger.info(f'The next valid order id is: {orderId}')
 
     def error(self, reqId, errorCode, errorString, foo=""):
-        self.error_ids.append(reqId)
         logger.debug(f'Error: {errorCode}, {errorString}')
+        # 21xx are connectivity/farm status notices, not failures of the request
+        if not 2100 <= errorCode < 2200:
+            self.contract_details.pop(reqId, None)
+            self.pending.fail(reqId, IBRequestError(reqId, errorCode, errorString))
 
     def contractDetails(self, reqId: int, contractDetails):
         super().contractDetails(reqId, contractDetails)
         symbol = contractDetails.contract.symbol
         conid = contractDetails.contract.conId
         self.ticker_to_conId[symbol] = conid
+        if reqId in self.pending:
+            self.contract_details[reqId].append(contractDetails)
 
     def contractDetailsEnd(self, reqId: int):
         super().contractDetailsEnd(reqId)
         logger.debug(f'contract details end for :{reqId}')
-        self.contract_details_end.append(reqId)
-
-    def validate_opt_contract(self, contract_to_varify):
+        self.pending.resolve(reqId, self.contract_details.pop(reqId, []))
+
+    def req_contract_details(self, contract, reqId=None, timeout=15):
+        """
+        Request contract details and block until they arrive, returns the list of ContractDetails or None on
+        error/timeout
+        """
+        if reqId is None:
+            reqId = self.ids.next_request_id()
+        future = self.pending.register(reqId)
+        self.reqContractDetails(reqId, contract)
         try:
-            self.nextorderId += 1
-            reqId = self.nextorderId
-            self.reqContractDetails(reqId, contract_to_varify)
-            # in seconds
-            TIME_OUT = 15
-            start_time = time.time()
-            while reqId not in self.contract_details_end + self.error_ids:
-                if time.time() - start_time > TIME_OUT:
-                    logger.debug(f'Error: Time out for :{reqId}')
-                    return False
-                time.sleep(0.1)
-            if reqId in self.contract_details_end:
-                return True
+            return future.result(timeout=timeout)
+        except futures.TimeoutError:
+            self.pending.discard(reqId)
+            self.contract_details.pop(reqId, None)
+            logger.debug(f'Error: Time out for :{reqId}')
+        except IBRequestError as e:
             logger.debug(f'Error: Wrong Contract Defination for {reqId}')
-            return False
-        except Exception as e:
-            logger.exception(e)
+            # 200: no security definition, the strike/expiry doesn't exist so no point asking again this session
+            if e.error_code == 200:
+                self.invalid_contracts.add(ContractCache.contract_key(contract))
+        return None
+
+    def get_con_id(self, contract, reqId=None):
+        """
+        conId of the contract from the contract cache or else from contract details (cached for the next sessions),
+        also set on the contract; None when the contract is not valid
+        """
+        key = ContractCache.contract_key(contract)
+        if key in self.invalid_contracts:
+            return None
+        con_id = self.contract_cache.get_con_id(contract)
+        if con_id is None:
+            # The prefetcher and TSP.run can look up the same strike at the same time, the second one waits for the
+            # request of the first
+            with self._con_id_lock:
+                lookup = self.con_id_lookups.get(key)
+                owner = lookup is None
+                if owner:
+                    lookup = self.con_id_lookups[key] = futures.Future()
+            if not owner:
+                con_id = lookup.result()
+            else:
+                try:
+                    contract_details = self.req_contract_details(contract, reqId=reqId)
+                    if contract_details:
+                        con_id = contract_details[0].contract.conId
+                        self.contract_cache.set_con_id(contract, con_id)
+                finally:
+                    with self._con_id_lock:
+                        del self.con_id_lookups[key]
+                    lookup.set_result(con_id)
+            if con_id is None:
+                return None
+        contract.conId = con_id
+        return con_id
 
-    def validate_hist_data_reqId(self, reqId):
+    def validate_opt_contract(self, contract_to_varify):
         try:
-            TIME_OUT = 25
-            start_time = time.time()
-            while reqId not in list(self.data_frames.keys()) + self.error_ids:
-                if time.time() - start_time > TIME_OUT:
-                    return False
-                time.sleep(0.1)
-            if reqId in self.data_frames:
-                return True
-            return False
+            return self.get_con_id(contract_to_varify) is not None
         except Exception as e:
             logger.exception(e)
             return False
@@ -109,63 +221,157 @@ class IBapi(EWrapper, EClient):
                                           tradingClass: str, multiplier: str, expirations, strikes):
         super().securityDefinitionOptionParameter(reqId, exchange, underlyingConId, tradingClass, multiplier,
                                                   expirations, strikes)
-        data = {'underlying_symbol': tradingClass, 'lot_size': int(multiplier), 'strikes': list(strikes),
-                'expiry_dates': sorted([parse(d).date() for d in expirations])}
-        self.options_data[reqId][exchange] = data
         local_symbol = self.sec_id_to_local_symbol[reqId].split()
         ticker, sec_type, curr, exch = local_symbol
-        if str(exch) == str(exchange):
-            if ticker not in self.contract_chain:
-                self.contract_chain[ticker] = {}
-                for expiry in sorted(expirations):
-                    self.contract_chain[ticker][expiry] = sorted(strikes)
-            self.secContract_details_end.append(ticker)
+        if str(exch) == str(exchange) and ticker not in self.contract_chain:
+            chain = {expiry: sorted(strikes) for expiry in sorted(expirations)}
+            self.contract_cache.set_chain(ticker, chain)
+            self.set_contract_chain(ticker, chain)
+
+    def set_contract_chain(self, ticker, chain):
+        self.option_chains[ticker] = OptionChain(chain)
+        self.contract_chain[ticker] = chain
+        self.secContract_details_end.add(ticker)
+        self.events.publish(EventDispatcher.CHAIN, ticker)
+
+    def securityDefinitionOptionParameterEnd(self, reqId: int):
+        super().securityDefinitionOptionParameterEnd(reqId)
+        self.pending.resolve(reqId)
+
+    def req_historical_data_cached(self, reqId, contract, durationStr, barSizeSetting, whatToShow, useRTH,
+                                   keepUpToDate=True):
+        """
+        reqHistoricalData for only the bars missing from the disk cache, the backfill gets merged with the cached
+        bars in load_bar_store and saved back
+        """
+        path = self.bar_cache.path(contract.symbol, barSizeSetting, whatToShow, useRTH)
+        cached = self.bar_cache.load(path, durationStr)
+        if cached is not None:
+            durationStr = tail_duration(cached.ts[-1])
+            logger.debug(f'{reqId}: {len(cached)} cached bars loaded for {contract.symbol}, requesting {durationStr}')
+        self.cached_bars[reqId] = (path, cached)
+        self.reqHistoricalData(reqId=reqId, contract=contract, durationStr=durationStr, barSizeSetting=barSizeSetting,
+                               whatToShow=whatToShow, useRTH=useRTH, endDateTime='', formatDate=1,
+                               keepUpToDate=keepUpToDate, chartOptions=[])
 
     def historicalData(self, reqId, bar):
-
-        date_str = bar.date if len(bar.date.split()) < 2 else bar.date.split()[0] + ' ' + bar.date.split()[1]
-        data = {'datetime': parse(date_str).astimezone(pytz.timezone('US/Eastern')), 'open': bar.open,
-                'high': bar.high, 'low': bar.low,
-                'close': bar.close, 'volume': bar.volume}
-        self.data[reqId].append(data)
+        self.data[reqId].append((bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume))
 
     def historicalDataUpdate(self, reqId, bar):
-        date_str = bar.date if len(bar.date.split()) < 2 else bar.date.split()[0] + ' ' + bar.date.split()[1]
-        bar_date_time = parse(date_str).astimezone(TZ)
+        bar_date_time = parse_ib_time(bar.date)
 
-        data = {'open': bar.open, 'high': bar.high, 'low': bar.low, 'close': bar.close, 'volume': bar.volume}
+        if reqId not in self.bar_stores:
+            self.load_bar_store(reqId, self.data.pop(reqId, []), rth_only=not self.extended_hours_data)
 
-        if not len(self.data_frames[reqId]):
-            df = pd.DataFrame(self.data[reqId])
-            del self.data[reqId]
-            df['datetime'] = pd.to_datetime(df['datetime'])
-            df = df.set_index('datetime')
-            if not self.extended_hours_data:
-                df = df.between_time('09:30', '15:59')
-            self.data_frames[reqId] = df
-            logger.debug(f'{reqId}: Historical Data fetched for id: {reqId}')
+        if self.update_bar(reqId, bar_date_time, bar.open, bar.high, bar.low, bar.close, bar.volume):
+            self.events.publish(EventDispatcher.BAR, reqId)
 
-        self.data_frames[reqId].loc[bar_date_time] = data
+    def update_bar(self, reqId, dt, open, high, low, close, volume):
+        if not self.bar_stores[reqId].append(dt, open, high, low, close, volume):
+            return False
+        self.vwaps[reqId].update(dt, high, low, close, volume)
+        self.stdevs[reqId].update(dt, close)
+        return True
+
+    def req_live_bars(self, reqId, contract, source, barSizeSetting, useRTH):
+        """
+        Keep the bars of reqId up to date from tick-by-tick trades (source 'tick_by_tick') or 5 second real time
+        bars ('realtime_bars') instead of keepUpToDate. Call it before the historical request of reqId, data that
+        comes before the backfill is merged in once it's loaded
+        """
+        streamId = self.ids.next_request_id()
+        self.live_bars[reqId] = BarAggregator(barSizeSetting, rth_only=bool(useRTH))
+        self.live_bar_streams[streamId] = (reqId, source)
+        if source == 'tick_by_tick':
+            self.reqTickByTickData(streamId, contract, 'AllLast', 0, False)
+        else:
+            self.reqRealTimeBars(streamId, contract, 5, 'TRADES', bool(useRTH), [])
+        return streamId
+
+    def cancel_live_bars(self):
+        for streamId, (reqId, source) in list(self.live_bar_streams.items()):
+            if source == 'tick_by_tick':
+                self.cancelTickByTickData(streamId)
+            else:
+                self.cancelRealTimeBars(streamId)
+        self.live_bar_streams.clear()
+
+    def update_live_bar(self, streamId, ts, open, high, low, close, volume):
+        reqId, source = self.live_bar_streams.get(streamId, (None, None))
+        aggregator = self.live_bars.get(reqId)
+        if aggregator is None:
+            return
+        bar = aggregator.update(ts, open, high, low, close, volume)
+        if bar is not None and self.update_bar(reqId, *bar):
+            self.events.publish(EventDispatcher.BAR, reqId)
+
+    def tickByTickAllLast(self, reqId, tickType, time, price, size, tickAttribLast, exchange, specialConditions):
+        self.update_live_bar(reqId, time, price, price, price, price, size)
+
+    def realtimeBar(self, reqId, time, open_, high, low, close, volume, wap, count):
+        self.update_live_bar(reqId, time, open_, high, low, close, volume)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
-        df = pd.DataFrame(self.data[reqId])
-        del self.data[reqId]
-        df = df.set_index('datetime')
-        self.data_frames[reqId] = df
+        self.load_bar_store(reqId, self.data.pop(reqId, []))
+
+    def load_bar_store(self, reqId, rows, rth_only=False):
+        dates, open, high, low, close, volume = zip(*rows) if rows else ([],) * 6
+        index = parse_ib_times(list(dates))
+        ts = to_epoch_seconds(index)
+        values = [np.asarray(v, dtype=np.float64) for v in (open, high, low, close, volume)]
+        if rth_only:
+            minutes = np.asarray(index.hour * 60 + index.minute)
+            mask = (minutes >= 9 * 60 + 30) & (minutes <= 15 * 60 + 59)
+            ts, values = ts[mask], [v[mask] for v in values]
+
+        path, cached = self.cached_bars.pop(reqId, (None, None))
+        if cached is not None:
+            # Fetched bars win over the cached ones from the first fetched timestamp on
+            keep = cached.ts < ts[0] if len(ts) else slice(None)
+            ts = np.concatenate([cached.ts[keep], ts])
+            values = [np.concatenate([getattr(cached, field)[keep], v]) for field, v in zip(BarStore.FIELDS, values)]
+        store = BarStore.from_arrays(ts, *values)
+        if path is not None:
+            self.bar_cache.save(path, store)
+
+        vwap, stdev = SessionVwap(), RollingStd()
+        for ts, open, high, low, close, volume in store.rows():
+            vwap.update(ts, high, low, close, volume)
+            stdev.update(ts, close)
+        self.vwaps[reqId] = vwap
+        self.stdevs[reqId] = stdev
+        self.bar_stores[reqId] = store
+        aggregator = self.live_bars.get(reqId)
+        if aggregator is not None:
+            for bar in aggregator.start(store):
+                self.update_bar(reqId, *bar)
+        self.events.publish(EventDispatcher.BAR, reqId)
+        self.pending.resolve(reqId, store)
         logger.debug(f'{reqId}: Historical Data fetched for id: {reqId}')
 
     def stop_streaming(self, reqId):
-        super().cancelMktData(reqId)
+        self.cancelMktData(reqId)
 
     def orderStatus(self, orderId, status, filled, remaining, avgFullPrice, permId, parentId, lastFillPrice, clientId,
                     whyHeld, mktCapPrice):
-        self.orders.append({'order_id': orderId, 'status': status, 'avg_price': avgFullPrice, 'filled': filled})
+        # TWS repeats the same status many times, only changes are kept and published
+        order = self.order_status.get(orderId)
+        if order is not None and order['status'] == status and order['filled'] == filled:
+            return
+        self.order_status[orderId] = {'order_id': orderId, 'status': status, 'avg_price': avgFullPrice,
+                                      'filled': filled, 'remaining': remaining}
+        self.events.publish(EventDispatcher.ORDER, orderId)
 
     def execDetails(self, reqId, contract, execution):
-        self.exec_orders.append({'order_id': reqId, 'symbol': contract.symbol, 'exec_order_id': execution.orderId,
-                                 'exec_avg_price': execution.avgPrice, 'exec_qty': execution.cumQty,
-                                 'exec_time': parse(
-                                     execution.time.split()[0] + ' ' + execution.time.split()[1]).astimezone(TZ)})
+        # cumQty/avgPrice are cumulative for the order, so the execution with the highest cumQty is its fill so far
+        exec_order = self.executions.get(execution.orderId)
+        if exec_order is not None and exec_order['exec_qty'] >= execution.cumQty:
+            return
+        self.executions[execution.orderId] = {'order_id': reqId, 'symbol': contract.symbol,
+                                              'exec_order_id': execution.orderId,
+                                              'exec_avg_price': execution.avgPrice, 'exec_qty': execution.cumQty,
+                                              'exec_time': parse_ib_time(execution.time)}
+        self.events.publish(EventDispatcher.EXECUTION, execution.orderId)
         # if execution.orderId in self.filled_open_order_Ids:
         #     d = {'symbol': contract.symbol, 'right': contract.right, 'ltp': execution.price, 'side': execution.side,
         #          'expiry': contract.lastTradeDateOrContractMonth, 'order_id': execution.orderId,
@@ -197,7 +403,8 @@ class IBapi(EWrapper, EClient):
         super().tickOptionComputation(reqId, tickType, tickAttrib, impliedVol, delta, optPrice, pvDividend, gamma, vega,
                                       theta, undPrice)
         if optPrice and tickType == 12:
-            self.reqId_to_ltp[reqId] = optPrice
+            self.ticks.put(reqId, optPrice)
+            self.events.publish(EventDispatcher.TICK, reqId)
 
     @staticmethod
     def make_contract(symbol, sec_type, exch='SMART', prim_exch=None, curr='USD', opt_type='C', expiry_date=None,
@@ -225,7 +432,7 @@ class IBapi(EWrapper, EClient):
         return contract
 
     @staticmethod
-    def make_order(action, quantity, order_type, price=None, stop_price=None, spread_order=False):
+    def make_order(action, quantity, order_type, price=None, stop_price=None, trail_amount=None, spread_order=False):
         order = Order()
         order.eTradeOnly = False
         order.firmQuoteOnly = False
@@ -244,5 +451,9 @@ class IBapi(EWrapper, EClient):
             order.lmtPrice = price
         elif order_type == 'STP':
             order.auxPrice = stop_price
+        elif order_type == 'TRAIL':
+            # Same as OrderSamples.TrailingStop but trailing by an amount, stop_price being the initial stop
+            order.auxPrice = trail_amount
+            order.trailStopPrice = stop_price
 
         return order
@@ -0,0 +1,77 @@
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import pytz
+from dateutil.tz import tzlocal
+
+from trading_bot.settings import TZ
+
+"""
+Parsers for the fixed timestamp formats IB sends: 'YYYYMMDD', 'YYYYMMDD HH:MM:SS [tz]' (one or two spaces),
+'YYYYMMDD-HH:MM:SS' (UTC) and epoch seconds (formatDate=2). Times without a zone are in the local zone of the
+machine running TWS, which is assumed to be this one.
+"""
+
+LOCAL_TZ = tzlocal()
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    return pytz.timezone(name)
+
+
+@lru_cache(maxsize=4096)
+def zone_info(name, year, month, day, hour):
+    # pytz's localize is the expensive part of a parse and DST only switches on the hour, so the resolved
+    # zone offset is cached per hour
+    return get_timezone(name).localize(datetime(year, month, day, hour)).tzinfo
+
+
+def parse_ib_time(value, tz=TZ):
+    parts = value.split()
+    day = parts[0]
+    if len(parts) == 1:
+        if '-' in day:
+            day, clock = day.split('-')
+            dt = datetime(int(day[:4]), int(day[4:6]), int(day[6:8]), int(clock[:2]), int(clock[3:5]),
+                          int(clock[6:8]), tzinfo=pytz.utc)
+            return dt.astimezone(tz)
+        if len(day) != 8:
+            return datetime.fromtimestamp(int(day), tz=tz)
+        return datetime(int(day[:4]), int(day[4:6]), int(day[6:8])).astimezone(tz)
+
+    clock = parts[1]
+    year, month, day, hour = int(day[:4]), int(day[4:6]), int(day[6:8]), int(clock[:2])
+    if len(parts) > 2:
+        dt = datetime(year, month, day, hour, int(clock[3:5]), int(clock[6:8]),
+                      tzinfo=zone_info(parts[2], year, month, day, hour))
+        return dt if parts[2] == tz.zone else dt.astimezone(tz)
+    return datetime(year, month, day, hour, int(clock[3:5]), int(clock[6:8])).astimezone(tz)
+
+
+def parse_ib_times(values, tz=TZ):
+    """
+    Vectorized parse_ib_time for a whole backfill, all values are expected in the same format
+    """
+    if not len(values):
+        return pd.DatetimeIndex([], tz=tz)
+
+    parts = values[0].split()
+    if len(parts) == 1 and '-' in parts[0]:
+        index = pd.to_datetime(values, format='%Y%m%d-%H:%M:%S').tz_localize(pytz.utc)
+    elif len(parts) == 1 and len(parts[0]) != 8:
+        index = pd.to_datetime(np.asarray(values, dtype=np.int64), unit='s', utc=True)
+    elif len(parts) == 1:
+        index = pd.to_datetime(values, format='%Y%m%d').tz_localize(LOCAL_TZ)
+    else:
+        index = pd.to_datetime([' '.join(v.split()[:2]) for v in values], format='%Y%m%d %H:%M:%S')
+        # Ambiguous wall times resolve to standard time, same as pytz's localize default
+        index = index.tz_localize(get_timezone(parts[2]) if len(parts) > 2 else LOCAL_TZ,
+                                  ambiguous=np.zeros(len(index), dtype=bool), nonexistent='shift_forward')
+    return index.tz_convert(tz)
+
+
+def to_epoch_seconds(index):
+    return index.tz_convert(pytz.utc).tz_localize(None).values.astype('datetime64[s]').astype(np.int64)
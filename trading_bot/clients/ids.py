@@ -0,0 +1,59 @@
+import threading
+
+from trading_bot.settings import logger
+
+
+class IdAllocator:
+    """
+    Thread safe ids for IBapi. Order ids continue from nextValidId; request ids (contract details, market data,
+    historical data...) come from their own range starting at REQUEST_ID_START so they never use up order ids.
+    Blocks of consecutive ids are handed out under one lock, e.g. the three request ids of a symbol bootstrap.
+
+    TWS rejects an order id lower than one it has seen already, so trade managers running on different threads hold
+    place_lock from taking new order ids until their placeOrder calls are queued, which keeps the ids going out in
+    the order they were handed out.
+    """
+    # Order ids keep growing over the life of the account, request ids start far above them (and below the 32 bit
+    # int limit of TWS) so an error for an order id is never taken for one of a request
+    REQUEST_ID_START = 1000000000
+
+    def __init__(self, request_id_start=REQUEST_ID_START):
+        self._lock = threading.Lock()
+        self.place_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._next_order_id = None
+        self._request_id_start = request_id_start
+        self._next_request_id = request_id_start
+
+    def set_next_order_id(self, order_id):
+        # nextValidId comes again after reconnects/reqIds, never go back to ids already handed out
+        with self._lock:
+            if self._next_order_id is None or order_id > self._next_order_id:
+                self._next_order_id = order_id
+        self._ready.set()
+
+    def order_ids(self, count, timeout=10):
+        """
+        range of count consecutive order ids, waits for nextValidId if it hasn't come yet
+        """
+        if not self._ready.wait(timeout):
+            raise RuntimeError('Next valid order id not received from TWS')
+        with self._lock:
+            start = self._next_order_id
+            self._next_order_id += count
+        if start + count > self._request_id_start:
+            logger.error(f'Order ids reached the request id range starting at {self._request_id_start}, '
+                         f'errors of order {start} can be taken for the ones of a request')
+        return range(start, start + count)
+
+    def request_ids(self, count):
+        with self._lock:
+            start = self._next_request_id
+            self._next_request_id += count
+        return range(start, start + count)
+
+    def next_order_id(self, timeout=10):
+        return self.order_ids(1, timeout)[0]
+
+    def next_request_id(self):
+        return self.request_ids(1)[0]
@@ -0,0 +1,84 @@
+from datetime import datetime
+
+from trading_bot.settings import TZ
+
+BAR_SIZE_SECONDS = {'sec': 1, 'secs': 1, 'min': 60, 'mins': 60, 'hour': 3600, 'hours': 3600}
+
+
+def bar_seconds(bar_size):
+    """
+    Seconds of an intraday IB bar size like '1 min' or '15 mins', ValueError for daily and longer bars
+    """
+    count, unit = bar_size.split()
+    if unit not in BAR_SIZE_SECONDS:
+        raise ValueError(f'Bar size {bar_size} can not be built from live data')
+    return int(count) * BAR_SIZE_SECONDS[unit]
+
+
+class BarAggregator:
+    """
+    Builds the bars of one bar size locally from trades (tickByTickAllLast) or 5 second bars (realtimeBar). Bars
+    are aligned to the exchange clock like IB's, with the first regular hours bar starting at 9:30. The last
+    backfilled bar is carried on when the data falls in its period.
+
+    Data that comes before the backfill is kept and merged in by start(); trades already counted in the backfill's
+    bar in progress can be counted again, which only affects that one bar.
+    """
+    RTH_START = 9 * 3600 + 30 * 60
+    RTH_END = 16 * 3600
+
+    def __init__(self, bar_size, rth_only=True, tz=TZ):
+        self.seconds = bar_seconds(bar_size)
+        self.rth_only = rth_only
+        self.tz = tz
+        # [period start, bar datetime, open, high, low, close, volume]
+        self.bar = None
+        self.started = False
+        self.pending = []
+
+    def start(self, store):
+        """
+        Continue from the last bar of the backfilled store, yields the bars changed by the data that came before
+        """
+        if len(store):
+            dt = store.datetime_at(len(store) - 1)
+            self.bar = [self._period(int(dt.timestamp()))[0], dt] + [float(getattr(store, field)[-1])
+                                                                     for field in store.FIELDS]
+        self.started = True
+        pending, self.pending = self.pending, []
+        for data in pending:
+            bar = self.update(*data)
+            if bar is not None:
+                yield bar
+
+    def _period(self, ts):
+        local = ts + int(datetime.fromtimestamp(ts, self.tz).utcoffset().total_seconds())
+        second_of_day = local % 86400
+        return ts - local % self.seconds, ts - second_of_day, second_of_day
+
+    def update(self, ts, open, high, low, close, volume):
+        """
+        Merge a trade (open = high = low = close) or a smaller bar, returns (datetime, open, high, low, close,
+        volume) of the bar it went into or None if it was dropped
+        """
+        ts = int(ts)
+        if not self.started:
+            self.pending.append((ts, open, high, low, close, volume))
+            return None
+
+        period, day_start, second_of_day = self._period(ts)
+        if self.rth_only and not self.RTH_START <= second_of_day < self.RTH_END:
+            return None
+        bar = self.bar
+        if bar is not None and period < bar[0]:
+            return None
+        if bar is None or period > bar[0]:
+            start = max(period, day_start + self.RTH_START) if self.rth_only else period
+            self.bar = bar = [period, datetime.fromtimestamp(start, self.tz), float(open), float(high), float(low),
+                              float(close), 0.0]
+        else:
+            bar[3] = max(bar[3], float(high))
+            bar[4] = min(bar[4], float(low))
+            bar[5] = float(close)
+        bar[6] += float(volume)
+        return tuple(bar[1:])
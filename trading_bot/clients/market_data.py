@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+from trading_bot.clients.contract_cache import ContractCache
+from trading_bot.settings import logger
+
+
+class _Line:
+    __slots__ = ('reqId', 'contract', 'consumers')
+
+    def __init__(self, reqId, contract):
+        self.reqId = reqId
+        self.contract = contract
+        self.consumers = 0
+
+
+class MarketDataLines:
+    """
+    reqMktData streams shared per contract: acquire() hands out the reqId of the contract's stream (starting it if
+    needed) and counts the consumer, release() drops it. Lines without consumers stay open so the next acquire of
+    the same contract is free, and are cancelled least recently used first when a new line would go over
+    max_lines (the market data lines of the account, 100 by default at IB).
+    """
+    GENERIC_TICK_LIST = "106,100,101"
+
+    def __init__(self, client, max_lines=100):
+        self.client = client
+        self.max_lines = max_lines
+        self.lines = OrderedDict()
+        self.reqId_to_key = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, contract):
+        key = ContractCache.contract_key(contract)
+        with self._lock:
+            line = self.lines.get(key)
+            if line is not None:
+                line.consumers += 1
+                self.lines.move_to_end(key)
+                return line.reqId
+            evicted = self._evict(len(self.lines) + 1 - self.max_lines)
+            line = _Line(self.client.ids.next_request_id(), contract)
+            line.consumers = 1
+            self.lines[key] = line
+            self.reqId_to_key[line.reqId] = key
+        for old in evicted:
+            self._cancel(old)
+        self.client.reqMktData(reqId=line.reqId, contract=contract, genericTickList=self.GENERIC_TICK_LIST,
+                               snapshot=False, regulatorySnapshot=False, mktDataOptions=[])
+        return line.reqId
+
+    def release(self, reqId):
+        with self._lock:
+            key = self.reqId_to_key.get(reqId)
+            if key is None:
+                return
+            line = self.lines[key]
+            line.consumers = max(0, line.consumers - 1)
+
+    def _evict(self, count):
+        # Least recently used idle lines first, lines in use are never cancelled
+        evicted = []
+        for key in list(self.lines):
+            if len(evicted) >= count:
+                break
+            if not self.lines[key].consumers:
+                evicted.append(self.lines.pop(key))
+                del self.reqId_to_key[evicted[-1].reqId]
+        if len(evicted) < count:
+            logger.debug(f'Market data lines limit {self.max_lines} reached and all lines are in use')
+        return evicted
+
+    def _cancel(self, line):
+        logger.debug(f'{line.reqId}: market data line of {ContractCache.contract_key(line.contract)} cancelled')
+        self.client.cancelMktData(line.reqId)
+        self.client.ticks.pop(line.reqId)
+
+    def close(self):
+        with self._lock:
+            lines = list(self.lines.values())
+            self.lines.clear()
+            self.reqId_to_key.clear()
+        for line in lines:
+            self._cancel(line)
@@ -0,0 +1,49 @@
+from bisect import bisect_left
+from datetime import datetime
+
+import numpy as np
+
+
+class OptionChain:
+    """
+    Expiries and strikes of one underlying indexed once when the chain arrives: parsed expiry dates and per expiry
+    a sorted strike array with a whole dollar mask, so the strike lookups are binary searches
+    """
+
+    def __init__(self, chain):
+        self.expiry_strings = sorted(chain)
+        self.expiries = [datetime.strptime(expiry, '%Y%m%d').date() for expiry in self.expiry_strings]
+        self.strikes = {}
+        self.whole_strikes = {}
+        self.whole_index = {}
+        for expiry in self.expiry_strings:
+            strikes = np.unique(np.asarray(chain[expiry], dtype=np.float64))
+            whole = strikes % 1 == 0
+            self.strikes[expiry] = strikes
+            self.whole_strikes[expiry] = strikes[whole]
+            self.whole_index[expiry] = np.flatnonzero(whole)
+
+    def expiry_on_or_after(self, date):
+        i = bisect_left(self.expiries, date)
+        return self.expiry_strings[i] if i < len(self.expiries) else None
+
+    def nearest_whole_strike_index(self, expiry, price):
+        """
+        Index in strikes[expiry] of the whole dollar strike closest to price, the lower one on ties
+        """
+        whole = self.whole_strikes[expiry]
+        if not len(whole):
+            return None
+        j = int(np.searchsorted(whole, price))
+        if j == len(whole) or (j > 0 and price - whole[j - 1] <= whole[j] - price):
+            j -= 1
+        return int(self.whole_index[expiry][j])
+
+    def candidates(self, expiry, price):
+        """
+        Strikes from the nearest whole dollar strike upwards, in the order they should be tried
+        """
+        i = self.nearest_whole_strike_index(expiry, price)
+        if i is None:
+            return self.strikes[expiry][:0]
+        return self.strikes[expiry][i:]
@@ -0,0 +1,185 @@
+import threading
+import time
+from collections import Counter, deque
+
+from trading_bot.settings import logger
+
+# Lanes, orders/cancels always go out before any queued data request
+PRIORITY = 0
+DATA = 1
+
+
+def historical_data_class(bar_size):
+    """
+    Message class of a reqHistoricalData, the 60 requests per 10 minutes pacing of IB only applies to bars of 30
+    seconds or less
+    """
+    count, unit = bar_size.split()
+    return 'hist' if unit.startswith('sec') and int(count) <= 30 else 'hist_bars'
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Message:
+    __slots__ = ('cls', 'key', 'send', 'enqueued')
+
+    def __init__(self, cls, key, send, enqueued):
+        self.cls = cls
+        self.key = key
+        self.send = send
+        self.enqueued = enqueued
+
+
+class OutboundScheduler:
+    """
+    Paces the messages IBapi sends to TWS from one sender thread: a global token bucket below the ~50 msg/s limit
+    of TWS plus per message class buckets (historical data of bars up to 30 seconds: 60 requests per 10 minutes).
+    Orders and cancels have their own lane ahead of data requests. A placeOrder for an order id that is still
+    queued replaces the queued one, so a burst of modifies of the same order goes out as one message.
+    """
+    MESSAGES_PER_SECOND = 45
+    # Small burst so that no 1 second window goes over MESSAGES_PER_SECOND + BURST messages
+    BURST = 5
+    # class: (rate per second, burst), 'hist' being historical data requests of small bars
+    CLASS_LIMITS = {'hist': (1 / 60, 50)}
+    REPORT_INTERVAL = 60
+
+    def __init__(self, messages_per_second=MESSAGES_PER_SECOND, class_limits=None):
+        self.bucket = TokenBucket(messages_per_second, self.BURST)
+        class_limits = self.CLASS_LIMITS if class_limits is None else class_limits
+        self.class_buckets = {cls: TokenBucket(*limit) for cls, limit in class_limits.items()}
+        self.lanes = (deque(), deque())
+        self.queued = {}
+        self.closed = False
+        self.stats = self._new_stats()
+        self._interval_stats = self._new_stats()
+        self._last_report = time.monotonic()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='ib-outbound', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _new_stats():
+        return {'sent': 0, 'coalesced': 0, 'max_delay': 0.0, 'total_delay': 0.0}
+
+    def submit(self, lane, cls, send, key=None):
+        with self._condition:
+            if not self.closed:
+                queued = self.queued.get(key) if key is not None else None
+                if queued is not None:
+                    queued.send = send
+                    self.stats['coalesced'] += 1
+                    self._interval_stats['coalesced'] += 1
+                    return
+                message = _Message(cls, key, send, time.monotonic())
+                if key is not None:
+                    self.queued[key] = message
+                self.lanes[lane].append(message)
+                self._condition.notify()
+                return
+        # After close (disconnect) there is no sender thread anymore
+        send()
+
+    def depth(self):
+        return tuple(len(lane) for lane in self.lanes)
+
+    def metrics(self):
+        with self._condition:
+            stats = dict(self.stats)
+        sent = stats['sent']
+        return {'sent': sent, 'coalesced': stats['coalesced'], 'queue_depth': self.depth(),
+                'avg_delay': stats['total_delay'] / sent if sent else 0.0, 'max_delay': stats['max_delay']}
+
+    def close(self, timeout=5):
+        """
+        Send what is queued (up to timeout) and stop the sender thread, whatever is still queued after the timeout
+        is dropped
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            return
+        with self._condition:
+            dropped = Counter(message.cls for lane in self.lanes for message in lane)
+            for lane in self.lanes:
+                lane.clear()
+            self.queued.clear()
+            self._condition.notify()
+        logger.debug(f'Outbound messages not sent within {timeout}s of closing, dropped: {dict(dropped)}')
+        self._thread.join(timeout)
+
+    def _next(self):
+        with self._condition:
+            while True:
+                if self.closed and not any(self.lanes):
+                    return None
+                now = time.monotonic()
+                global_wait = self.bucket.wait_time(now)
+                wait = None
+                for lane in self.lanes:
+                    for i, message in enumerate(lane):
+                        bucket = self.class_buckets.get(message.cls)
+                        message_wait = max(global_wait, bucket.wait_time(now) if bucket is not None else 0)
+                        if not message_wait:
+                            del lane[i]
+                            self.bucket.take(now)
+                            if bucket is not None:
+                                bucket.take(now)
+                            if message.key is not None:
+                                del self.queued[message.key]
+                            return message
+                        wait = message_wait if wait is None else min(wait, message_wait)
+                        # Orders keep their order; data requests only skip ahead of ones held by their class limit
+                        if lane is self.lanes[PRIORITY] or message_wait == global_wait:
+                            break
+                self._condition.wait(wait)
+
+    def _run(self):
+        while True:
+            message = self._next()
+            if message is None:
+                return
+            delay = time.monotonic() - message.enqueued
+            try:
+                message.send()
+            except Exception as e:
+                logger.exception(e)
+            with self._condition:
+                for stats in (self.stats, self._interval_stats):
+                    stats['sent'] += 1
+                    stats['total_delay'] += delay
+                    stats['max_delay'] = max(stats['max_delay'], delay)
+            self._report()
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._last_report < self.REPORT_INTERVAL:
+            return
+        with self._condition:
+            stats, self._interval_stats = self._interval_stats, self._new_stats()
+        self._last_report = now
+        orders, data = self.depth()
+        logger.debug(f'Outbound messages in the last {self.REPORT_INTERVAL}s: {stats["sent"]} sent, '
+                     f'{stats["coalesced"]} coalesced, queue depth orders: {orders}, data: {data}, '
+                     f'avg delay: {1000 * stats["total_delay"] / stats["sent"]:.1f} ms, '
+                     f'max delay: {1000 * stats["max_delay"]:.1f} ms')
@@ -0,0 +1,48 @@
+import threading
+from concurrent.futures import Future
+
+
+class IBRequestError(Exception):
+    def __init__(self, req_id, error_code, error_string):
+        super().__init__(f'{req_id}: {error_code}, {error_string}')
+        self.req_id = req_id
+        self.error_code = error_code
+        self.error_string = error_string
+
+
+class PendingRequests:
+    """
+    One Future per outstanding request id. Callers register before sending the request and block on the future
+    (or await it through asyncio.wrap_future); the matching end/error callback resolves it and drops the entry,
+    so nothing accumulates for completed requests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def __contains__(self, key):
+        return key in self._futures
+
+    def register(self, key):
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = Future()
+        return future
+
+    def discard(self, key):
+        with self._lock:
+            self._futures.pop(key, None)
+
+    def resolve(self, key, result=None):
+        with self._lock:
+            future = self._futures.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def fail(self, key, exception):
+        with self._lock:
+            future = self._futures.pop(key, None)
+        if future is not None and not future.done():
+            future.set_exception(exception)
@@ -0,0 +1,94 @@
+import threading
+from datetime import datetime
+
+from trading_bot.clients.events import EventDispatcher
+from trading_bot.settings import logger, TZ
+
+
+class StrikePrefetcher:
+    """
+    Keeps the strikes TSP.run would try first already validated while the strategies wait for a signal: follows
+    the last price of every strategy still looking for a contract and validates the nearest `width` call strikes
+    of the target expiry in the background, so their conIds are in the contract cache when the signal fires.
+    With market_data the prefetcher also holds the market data line of the strike TSP would pick, so the line
+    the controller acquires for the new trade manager is already streaming.
+    """
+
+    def __init__(self, client, strats, width=3, market_data=False, interval=1):
+        self.client = client
+        self.strats = strats
+        self.width = width
+        self.market_data = market_data
+        self.interval = interval
+        self.lines = {}
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='strike-prefetcher', daemon=True)
+
+    def start(self):
+        self.client.events.subscribe(self._on_event)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        self.client.events.unsubscribe(self._on_event)
+        self._thread.join()
+        for reqId in self.lines.values():
+            self.client.market_data.release(reqId)
+        self.lines = {}
+
+    @staticmethod
+    def contract_key(contract):
+        return contract.symbol, str(contract.lastTradeDateOrContractMonth), contract.right, float(contract.strike)
+
+    def _on_event(self, kind, key):
+        if kind in (EventDispatcher.BAR, EventDispatcher.CHAIN):
+            self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            wanted = {}
+            for strat in list(self.strats.values()):
+                if strat.contract_fetched:
+                    continue
+                try:
+                    wanted.update(self.prefetch(strat))
+                except Exception as e:
+                    logger.exception(e)
+            if self.market_data and not self._stopped:
+                self._update_lines(wanted)
+
+    def prefetch(self, strat):
+        """
+        Validate the first strikes TSP.run would try for the strategy, returns {key: contract} of the one to
+        keep warm
+        """
+        bars = self.client.bar_stores.get(strat.id_2)
+        chain = self.client.option_chains.get(strat.ticker)
+        if bars is None or not len(bars) or chain is None:
+            return {}
+        expiry = chain.expiry_on_or_after(datetime.now(tz=TZ).date())
+        if expiry is None:
+            return {}
+
+        ready = {}
+        for strike in chain.candidates(expiry, float(bars.close[-1]))[:self.width]:
+            contract = self.client.make_contract(symbol=strat.ticker, sec_type='OPT', exch=strat.exch,
+                                                 curr=strat.curr, opt_type=strat.opt_type, expiry_date=expiry,
+                                                 strike=float(strike))
+            if self.client.contract_cache.get_con_id(contract) is None:
+                logger.debug(f'{strat.local_symbol}: prefetching {expiry} {float(strike)} {strat.opt_type}')
+            # Same validation TSP.run does, the first valid strike is the one it will pick
+            if self.client.validate_opt_contract(contract) and not ready:
+                ready[self.contract_key(contract)] = contract
+        return ready
+
+    def _update_lines(self, wanted):
+        for key in [key for key in self.lines if key not in wanted]:
+            self.client.market_data.release(self.lines.pop(key))
+        for key, contract in wanted.items():
+            if key not in self.lines:
+                self.lines[key] = self.client.market_data.acquire(contract)
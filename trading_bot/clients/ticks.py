@@ -0,0 +1,50 @@
+import threading
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+Tick = namedtuple('Tick', ['value', 'seq', 'recv_ts'])
+
+
+class TickMailbox:
+    """
+    Latest option price per reqId with a sequence number and the time it was received. Consumers remember the seq
+    they last acted on to tell a new tick from one they have already seen, and report the tick-to-decision age
+    of the ticks they act on with consumed()
+    """
+
+    def __init__(self, history=10000):
+        self._ticks = {}
+        self._lock = threading.Lock()
+        self.ages = deque(maxlen=history)
+
+    def put(self, reqId, value):
+        previous = self._ticks.get(reqId)
+        self._ticks[reqId] = Tick(value, previous.seq + 1 if previous is not None else 1, time.monotonic())
+
+    def get(self, reqId):
+        return self._ticks.get(reqId)
+
+    def pop(self, reqId):
+        return self._ticks.pop(reqId, None)
+
+    def __contains__(self, reqId):
+        return reqId in self._ticks
+
+    def consumed(self, tick):
+        age = time.monotonic() - tick.recv_ts
+        with self._lock:
+            self.ages.append(age)
+        return age
+
+    def metrics(self):
+        """
+        Tick-to-decision age of the recent consumed ticks, in seconds
+        """
+        with self._lock:
+            ages = np.fromiter(self.ages, dtype=np.float64)
+        if not len(ages):
+            return {'count': 0}
+        return {'count': len(ages), 'avg': float(ages.mean()), 'p50': float(np.percentile(ages, 50)),
+                'p99': float(np.percentile(ages, 99)), 'max': float(ages.max())}
@@ -3,44 +3,63 @@ import time
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import pandas as pd
 from dateutil.parser import parse
 
 from ibapi.client import ExecutionFilter
 from trading_bot.clients.ib import IBapi
-from trading_bot.database.db import engine, OptTradesData
-from trading_bot.database.db_handler import save_trade
+from trading_bot.clients.live_bars import bar_seconds
+from trading_bot.clients.prefetcher import StrikePrefetcher
+from trading_bot.database.db import OptTradesData
+from trading_bot.database.journal import TradeJournal
+from trading_bot.database.queries import daily_realized_pnl, open_trades
 from trading_bot.settings import logger, TZ
 from trading_bot.stretegies.tsp import TSP
 from trading_bot.trade_managers.opt_trade_manager import OptTradeManager
 
 
 class Controller:
-    def __init__(self, client):
+    # Up to this many woken managers are run on the controller thread, trade() doesn't block so handing a few of
+    # them to the pool costs more than it saves (see bench/bench_controller.py)
+    INLINE_MANAGERS = 10
+
+    def __init__(self, client, journal, max_workers=4):
         self.client = client
+        self.journal = journal
         self.strats = dict()
         self.trade_managers = list()
+        # One pool for the whole session, max_workers=0 runs every manager inline
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='trade-manager') \
+            if max_workers else None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
 
     @staticmethod
     def run_instance(obj):
         return obj.trade()
 
-    def run(self):
-        with ThreadPoolExecutor() as executor:
-            res = executor.map(self.run_instance, self.trade_managers)
+    def run(self, events, heartbeat_due, new_managers=()):
+        # Only managers with new ticks/order updates, plus all of them on heartbeat for time based exits. Just
+        # created ones always run, their option tick may be in the mailbox already without an event to come
+        trade_managers = [obj for obj in self.trade_managers
+                          if heartbeat_due or obj.trade_ended or obj in new_managers or obj.is_woken_by(events)]
+        if self.executor is None or len(trade_managers) <= self.INLINE_MANAGERS:
+            res = [self.run_instance(obj) for obj in trade_managers]
+        else:
+            res = list(self.executor.map(self.run_instance, trade_managers))
         res = [r for r in res if r is not None]
         for r in res:
             if isinstance(r, dict):
                 if r['msg']:
-                    model_class = OptTradesData
                     for i in r['msg']:
                         if i:
                             for k, v in i.items():
-                                save_trade(model_class, k, v)
+                                self.journal.save_trade(k, v)
             else:
                 if r.trade_ended:
                     self.trade_managers.remove(r)
-                    self.client.cancelMktData(r.id)
+                    self.client.market_data.release(r.id)
                     # del self.strats[self.symbol]
                     logger.debug(f'{r.identifier} instance removed from trading manager')
                     if not r.time_based_exit:
@@ -55,8 +74,22 @@ class Controller:
 
 def run(symbols, account_mode, time_frame, below_vwap_per, above_vwap_std_per, standard_deviation, trade_size,
         start_time, end_time, day_down_percent, stop_loss, tighter_stop_loss, trade_end_time, total_loss_amount,
-        below_vwap_std_per, calc_method):
+        below_vwap_std_per, calc_method, heartbeat=1, sl_order_type='STP', entry_order_type='MKT',
+        crash_safe_journal=False, prefetch_strikes=3, prefetch_market_data=False, max_workers=4,
+        bootstrap_workers=8, market_data_lines=100, bar_source='historical'):
     calc_method = calc_method.strip().lower()
+    sl_order_type = sl_order_type.strip().upper()
+    if sl_order_type not in ['STP', 'TRAIL']:
+        logger.debug(f'Invalid sl order type: {sl_order_type}, choices: STP, TRAIL')
+        return
+    entry_order_type = entry_order_type.strip().upper()
+    if entry_order_type not in ['MKT', 'BRACKET']:
+        logger.debug(f'Invalid entry order type: {entry_order_type}, choices: MKT, BRACKET')
+        return
+    bar_source = bar_source.strip().lower()
+    if bar_source not in ['historical', 'tick_by_tick', 'realtime_bars']:
+        logger.debug(f'Invalid bar source: {bar_source}, choices: historical, tick_by_tick, realtime_bars')
+        return
     try:
         start_time, end_time, trade_end_time = parse(start_time).time(), parse(end_time).time(), \
                                                parse(trade_end_time).time()
@@ -78,19 +111,18 @@ def run(symbols, account_mode, time_frame, below_vwap_per, above_vwap_std_per, s
         logger.debug(f'tighter stop loss: {tighter_stop_loss} must be less stop loss: {stop_loss}')
         return
 
-    table_name = 'opt_trades_data'
     time_frame = time_frame if calc_method == 'pta' else '1 min'
     duration = '1 Y' if calc_method == 'pta' else '1 M'
-
-    # OPEN & NON-EXPIRED
-    pos_stock_list = pd.read_sql(table_name, engine)
-    mask = (pos_stock_list['trading_mode'].str.upper() == account_mode.upper()) & \
-           (pos_stock_list['position_status'] == "CLOSED") & \
-           (pos_stock_list['exit_time'].dt.date == datetime.now(tz=TZ).date())
-    closed_pos_stock_list = pos_stock_list[mask]
-    exit_value = closed_pos_stock_list['exit_price'] * closed_pos_stock_list['quantity'] * 100
-    entry_value = closed_pos_stock_list['entry_price'] * closed_pos_stock_list['quantity'] * 100
-    closed_pnl = (exit_value - entry_value).sum()
+    live_bars = bar_source != 'historical'
+    if live_bars:
+        try:
+            bar_seconds(time_frame)
+        except ValueError as e:
+            logger.debug(f'{e}, use bar source historical for this time frame')
+            return
+
+    # CLOSED today
+    closed_pnl = daily_realized_pnl(account_mode, datetime.now(tz=TZ).date())
     if closed_pnl <= -total_loss_amount:
         logger.debug(f'Daily loss: {closed_pnl} is more than specified loss amount: {total_loss_amount}, '
                      f'so cannot trade further today')
@@ -99,40 +131,44 @@ def run(symbols, account_mode, time_frame, below_vwap_per, above_vwap_std_per, s
     # Connection
     what_type = 'TRADES'  # Type of data required, i.e. TRADES, BID_ASK, BID, ASK, MIDPOINT etc
     client = IBapi()
+    client.market_data.max_lines = market_data_lines
     socket_port = 7497 if account_mode.lower() == 'paper' else 7496
     client.connect('127.0.0.1', socket_port, 1)
     client_thread = threading.Thread(target=client.run, daemon=True)
     client_thread.start()
     time.sleep(3)
 
-    # controller
-    controller = Controller(client=client)
+    # controller, trade updates are written to the db by the journal thread
+    journal = TradeJournal(OptTradesData, crash_safe=crash_safe_journal)
+    controller = Controller(client=client, journal=journal, max_workers=max_workers)
 
     # Orders Requests
     client.reqAllOpenOrders()
     client.reqExecutions(10001, ExecutionFilter())
 
-    mask = (pos_stock_list['trading_mode'].str.upper() == account_mode.upper()) & \
-           ((pos_stock_list['position_status'] == "OPEN") | (pos_stock_list['entry_order_status'] == 'OPEN'))
-    open_pos_stock_list = pos_stock_list[mask]
-    open_pos_stock_list = list(open_pos_stock_list.T.to_dict().values())
+    # OPEN positions/orders
+    open_pos_stock_list = open_trades(account_mode)
     open_pos_symbols = {s['symbol']: s for s in open_pos_stock_list}
 
-    for i, trade in enumerate(open_pos_stock_list, start=client.nextorderId):
+    for trade in open_pos_stock_list:
         logger.info(f"Open position/order found in {trade['symbol']} {trade['opt_type']} "
                     f"option, reading parameters...")
         entry_order_filled = False if trade['entry_order_status'] == 'OPEN' else True
         bought = True if trade['side'] == 'LONG' else False
         sold = True if trade['side'] == 'SHORT' else False
         exit_pending = True if trade['exit_order_status'] == 'OPEN' else False
+        # SL of a bracket entry, modifications have to keep the parent. Rows saved before exit_parent_id was stored:
+        # an exit order placed while the entry is still open can only be a bracket child
+        exit_parent_id = trade['exit_parent_id']
+        if exit_parent_id is None and exit_pending and not entry_order_filled:
+            exit_parent_id = trade['entry_order_id']
         contract = client.make_contract(symbol=trade['symbol'],
                                         sec_type=trade['symbol_type'], exch=trade['exchange'],
                                         prim_exch=trade['exchange'], curr='USD',
                                         opt_type=trade['opt_type'],
                                         expiry_date=trade['expiry_date'], strike=float(trade['strike']))
         contract.lot_size = trade['lot_size']
-        client.reqMktData(reqId=i, contract=contract, genericTickList="106,100,101",
-                          snapshot=False, regulatorySnapshot=False, mktDataOptions=[])
+        i = client.market_data.acquire(contract)
         kwargs = {
             'client': client, 'unique_id': i, 'trading_mode': account_mode, 'contract': contract,
             'side': trade['side'], 'entered': True, 'entry_order_filled': entry_order_filled,
@@ -143,12 +179,16 @@ def run(symbols, account_mode, time_frame, below_vwap_per, above_vwap_std_per, s
             'trade_size': trade_size, 'exit_pending': exit_pending, 'exit_order_id': trade['exit_order_id'],
             'exit_order_price': trade['exit_order_price'], 'stop_loss': stop_loss,
             'tighter_stop_loss': tighter_stop_loss, 'current_loss': closed_pnl, 'total_loss_amount': total_loss_amount,
-            'trade_end_time': trade_end_time}
+            'trade_end_time': trade_end_time, 'sl_order_type': sl_order_type, 'entry_order_type': entry_order_type,
+            'exit_parent_id': int(exit_parent_id) if exit_parent_id is not None else None}
 
         controller.trade_managers.append(OptTradeManager(**kwargs))
-        client.nextorderId += 1
 
-    for symbol in symbols:
+    def bootstrap_symbol(symbol, contract_id, reqId, id_2):
+        """
+        conId, option chain and bars requests of one symbol, run on the bootstrap pool; the TSP instance is handed
+        back to the main loop
+        """
         ticker, sec_type, curr, exch = symbol, 'STK', 'USD', 'SMART'
         local_symbol = f'{ticker} {sec_type} {curr} {exch}'
 
@@ -161,57 +201,93 @@ def run(symbols, account_mode, time_frame, below_vwap_per, above_vwap_std_per, s
             contract_fetched = False
 
         # contract id of stock
-        client.nextorderId += 1
-        contract_id = client.nextorderId
         contract_1 = client.make_contract(symbol=ticker, sec_type=sec_type, exch=exch, curr=curr)
-        if not client.validate_opt_contract(contract_1):
-            continue
-        client.reqContractDetails(contract_id, contract_1)
         logger.debug(f'waiting For con id to be fetched for {ticker}')
-        while ticker not in client.ticker_to_conId:
-            pass
-        con_id = client.ticker_to_conId[ticker]
-
-        # reqSecDefOptParams
-        client.nextorderId += 1
-        reqId = client.nextorderId
-        client.sec_id_to_local_symbol[reqId] = local_symbol
-        client.reqSecDefOptParams(reqId=reqId,
-                                  underlyingSymbol=ticker,
-                                  futFopExchange="",
-                                  underlyingSecType=sec_type,
-                                  underlyingConId=con_id)
-
-        # reqHistoricalData
-        client.nextorderId += 1
-        contract_2 = client.make_contract(symbol=ticker, sec_type=sec_type, curr=curr, exch=exch)
-        if not client.validate_opt_contract(contract_2):
-            continue
-        id_2 = client.nextorderId
-        client.reqHistoricalData(reqId=id_2, contract=contract_2, durationStr=duration, barSizeSetting=time_frame,
-                                 whatToShow=what_type, useRTH=1, endDateTime='', formatDate=1, keepUpToDate=True,
-                                 chartOptions=[])
-
-        controller.strats[ticker] = TSP(client=client, local_symbol=local_symbol, unique_id_1=contract_id,
-                                        unique_id_2=id_2, below_vwap_per=below_vwap_per,
-                                        above_vwap_std_per=above_vwap_std_per, standard_deviation=standard_deviation,
-                                        start_time=start_time, end_time=end_time, day_down_percent=day_down_percent,
-                                        contract_fetched=contract_fetched, below_vwap_std_per=below_vwap_std_per,
-                                        calc_method=calc_method)
+        con_id = client.get_con_id(contract_1, reqId=contract_id)
+        if con_id is None:
+            return None
+
+        # reqSecDefOptParams, unless the chain of the day is cached already
+        chain = client.contract_cache.get_chain(ticker)
+        if chain is not None:
+            logger.debug(f'{ticker}: option chain loaded from cache')
+            client.set_contract_chain(ticker, chain)
+        else:
+            client.sec_id_to_local_symbol[reqId] = local_symbol
+            client.reqSecDefOptParams(reqId=reqId,
+                                      underlyingSymbol=ticker,
+                                      futFopExchange="",
+                                      underlyingSecType=sec_type,
+                                      underlyingConId=con_id)
+
+        # Live bars are subscribed first so no trade between the backfill and the subscription is missed
+        if live_bars:
+            client.req_live_bars(reqId=id_2, contract=contract_1, source=bar_source, barSizeSetting=time_frame,
+                                 useRTH=1)
+
+        # reqHistoricalData, contract_1 is the same stock contract and was validated by the conId lookup
+        client.req_historical_data_cached(reqId=id_2, contract=contract_1, durationStr=duration,
+                                          barSizeSetting=time_frame, whatToShow=what_type, useRTH=1,
+                                          keepUpToDate=not live_bars)
+
+        return TSP(client=client, local_symbol=local_symbol, unique_id_1=contract_id, unique_id_2=id_2,
+                   below_vwap_per=below_vwap_per, above_vwap_std_per=above_vwap_std_per,
+                   standard_deviation=standard_deviation, start_time=start_time, end_time=end_time,
+                   day_down_percent=day_down_percent, contract_fetched=contract_fetched,
+                   below_vwap_std_per=below_vwap_std_per, calc_method=calc_method)
+
+    # All symbols are bootstrapped concurrently (bootstrap_workers conId lookups in flight at a time) and the
+    # strategies join the main loop as they come in
+    bootstrap = ThreadPoolExecutor(max_workers=bootstrap_workers, thread_name_prefix='bootstrap')
+    bootstrapping = dict()
+    for symbol in symbols:
+        bootstrapping[bootstrap.submit(bootstrap_symbol, symbol, *client.ids.request_ids(3))] = symbol
+    bootstrap.shutdown(wait=False)
+
+    def collect_bootstrapped():
+        new_strats = []
+        for future in [f for f in bootstrapping if f.done()]:
+            symbol = bootstrapping.pop(future)
+            try:
+                tsp_obj = future.result()
+            except Exception as e:
+                logger.exception(e)
+                continue
+            if tsp_obj is None:
+                logger.debug(f'{symbol}: contract not found, strategy instance not started')
+                continue
+            controller.strats[tsp_obj.ticker] = tsp_obj
+            new_strats.append(tsp_obj)
+        return new_strats
+
+    # Validates the strikes the strategies would pick ahead of the signal
+    prefetcher = StrikePrefetcher(client, controller.strats, width=prefetch_strikes, market_data=prefetch_market_data)
+    if prefetch_strikes:
+        prefetcher.start()
 
     def run_instance(obj):
         return obj.run()
 
+    # Wait for bar/tick/order events from the client instead of spinning; heartbeat wakes everything up
+    # periodically for the time based checks
+    next_heartbeat = 0
     while True:
+        events = client.events.wait(timeout=heartbeat)
+        heartbeat_due = time.time() >= next_heartbeat
+        if heartbeat_due:
+            next_heartbeat = time.time() + heartbeat
+
+        # Just bootstrapped strategies may have missed their first bar events
+        new_strats = collect_bootstrapped()
+        new_managers = []
         tsp_obj_list = [obj for obj in controller.strats.values() if not obj.contract_fetched]
         for tsp_obj in tsp_obj_list:
+            if not heartbeat_due and not tsp_obj.is_woken_by(events) and tsp_obj not in new_strats:
+                continue
             tsp_return_contract = run_instance(tsp_obj)
             if tsp_return_contract:
-                # option ltp request sent
-                client.nextorderId += 1
-                reqId = client.nextorderId
-                client.reqMktData(reqId=reqId, contract=tsp_return_contract, genericTickList="106,100,101",
-                                  snapshot=False, regulatorySnapshot=False, mktDataOptions=[])
+                # option ltp line, shared with the prefetcher if it already streams this strike
+                reqId = client.market_data.acquire(tsp_return_contract)
 
                 # TradeManager instance
                 client = tsp_obj.client
@@ -219,16 +295,24 @@ def run(symbols, account_mode, time_frame, below_vwap_per, above_vwap_std_per, s
                                             contract=tsp_return_contract, side='LONG', trade_size=trade_size,
                                             stop_loss=stop_loss, tighter_stop_loss=tighter_stop_loss,
                                             current_loss=closed_pnl, total_loss_amount=total_loss_amount,
-                                            trade_end_time=trade_end_time)
+                                            trade_end_time=trade_end_time, sl_order_type=sl_order_type,
+                                            entry_order_type=entry_order_type)
                 controller.trade_managers.append(order_obj)
+                new_managers.append(order_obj)
 
         if len(controller.trade_managers):
-            msg = controller.run()
-            if msg == 'trade_ended':
+            msg = controller.run(events=events, heartbeat_due=heartbeat_due, new_managers=new_managers)
+            if msg == 'trade_ended' and not bootstrapping:
                 break
-        elif not len(tsp_obj_list):
+        elif not len(tsp_obj_list) and not bootstrapping:
             break
 
+    if prefetch_strikes:
+        prefetcher.stop()
+    controller.close()
+    journal.close()
+    client.cancel_live_bars()
+    client.market_data.close()
     client.disconnect()
     client_thread.join()
 
@@ -1,5 +1,5 @@
 from sqlalchemy import Column, String, Integer, DECIMAL, DATETIME, Float
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
@@ -13,6 +13,21 @@ Database schema and settings
 db_connection_url = f'sqlite:///{str(BASE_DIR)}/trades.sqlite3'
 
 engine = create_engine(db_connection_url, echo=False, connect_args={'check_same_thread': False})
+
+
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets the startup reads run alongside the journal writes, NORMAL sync only fsyncs on checkpoints in WAL mode
+    # (the crash safe journal switches its connections to FULL)
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-16000')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.close()
+
+
 base = declarative_base()
 
 
@@ -46,6 +61,7 @@ class OptTradesData(base):
     exit_order_price = Column(DECIMAL, nullable=True)
     exit_order_status = Column(String, nullable=True)
     exit_order_id = Column(String, nullable=True)
+    exit_parent_id = Column(String, nullable=True)
     exit_time = Column(DATETIME, nullable=True)
     exit_type = Column(String, nullable=True)
     exit_price = Column(DECIMAL, nullable=True)
@@ -87,9 +103,38 @@ class OptTradesData(base):
             session.close()
 
 
+# Trading mode filters of the startup queries, the trade_id lookups of db_handler use the unique trade_id index
+Index('ix_opt_trades_mode_position_exit', func.upper(OptTradesData.trading_mode), OptTradesData.position_status,
+      OptTradesData.exit_time)
+Index('ix_opt_trades_mode_entry_status', func.upper(OptTradesData.trading_mode), OptTradesData.entry_order_status)
+
+
+def migrate():
+    """
+    Upgrade an existing db in place, create_all only adds columns and indexes along with new tables
+    """
+    table = OptTradesData.__table__
+    with engine.begin() as conn:
+        existing = {row[1] for row in conn.execute(text(f'PRAGMA table_info({table.name})'))}
+        for column in table.columns:
+            if column.name not in existing:
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                                  f'{column.type.compile(engine.dialect)}'))
+                logger.debug(f'Added column {column.name} to {table.name}')
+
+    # Reflection skips expression indexes, so checking sqlite_master instead of checkfirst
+    with engine.begin() as conn:
+        existing = set(conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+        for index in OptTradesData.__table__.indexes:
+            if index.name not in existing:
+                index.create(conn)
+                logger.debug(f'Created index {index.name} on {OptTradesData.__tablename__}')
+
+
 # Create session
 Session = sessionmaker(engine)
 Session = scoped_session(Session)
 session = Session()
 
 base.metadata.create_all(engine)
+migrate()
@@ -1,69 +1,48 @@
 import warnings
 
-from trading_bot.database.db import session
 from trading_bot.settings import logger
 
 warnings.filterwarnings('ignore')
 
+NOT_FOUND_MESSAGES = {'confirm_entry': 'Trade not found', 'make_exit': 'Position not found',
+                      'confirm_exit': 'Open Position not found', 'status_closed': 'Open Position not found'}
 
-def save_trade(model_class, action, params):
+
+def find_trade(session, model_class, action, params):
+    if action == 'confirm_entry':
+        status_filter = model_class.entry_order_status == 'OPEN'
+    else:
+        status_filter = model_class.position_status == 'OPEN'
+    return session.query(model_class).filter(model_class.trade_id == params['trade_id'],
+                                             model_class.symbol == params['symbol'], status_filter).first()
+
+
+def apply_trade(session, model_class, action, params):
+    """
+    Apply a trade message to the session without committing it
+    """
+    params = dict(params)
     if action == 'make_entry':
-        obj = model_class(**params)
-        obj.save_to_db()
+        session.add(model_class(**params))
         logger.debug(f'Trade Saved for {params["symbol"]} for action: {action}')
-    elif action == 'confirm_entry':
-        obj = session.query(model_class).filter(model_class.trade_id == params['trade_id'],
-                                                model_class.symbol == params['symbol'],
-                                                model_class.entry_order_status == 'OPEN').first()
-        if not obj:
-            logger.debug(f'Trade not found for {params["symbol"]}, trade_id: {params["trade_id"]}')
-            return
-        symbol = params.pop('symbol')
-        del params['trade_id']
-        for k, v in params.items():
-            setattr(obj, k, v)
-        obj.commit_changes()
-        logger.debug(f'Trade modified for {symbol} for action: {action}')
-    elif action == 'make_exit':
-        obj = session.query(model_class).filter(model_class.trade_id == params['trade_id'],
-                                                model_class.symbol == params['symbol'],
-                                                model_class.position_status == 'OPEN').first()
-        if not obj:
-            logger.debug(f'Position not found for {params["symbol"]}, trade_id: {params["trade_id"]}')
-            return
-        symbol = params.pop('symbol')
-        del params['trade_id']
-        for k, v in params.items():
-            setattr(obj, k, v)
-        obj.commit_changes()
-        logger.debug(f'Trade modified for {symbol} for action: {action}')
-    elif action == 'confirm_exit':
-        obj = session.query(model_class).filter(model_class.trade_id == params['trade_id'],
-                                                model_class.symbol == params['symbol'],
-                                                model_class.position_status == 'OPEN').first()
-        if not obj:
-            logger.debug(f'Open Position not found for {params["symbol"]}, trade_id: {params["trade_id"]}')
-            return
-        symbol = params.pop('symbol')
-        del params['trade_id']
-        for k, v in params.items():
-            setattr(obj, k, v)
-        obj.commit_changes()
-        logger.debug(f'Trade modified for {symbol} for action: {action}')
+        return
 
-    elif action == 'status_closed':
-        obj = session.query(model_class).filter(model_class.trade_id == params['trade_id'],
-                                                model_class.symbol == params['symbol'],
-                                                model_class.position_status == 'OPEN').first()
-        if not obj:
-            logger.debug(f'Open Position not found for {params["symbol"]}, trade_id: {params["trade_id"]}')
-            return
-        symbol = params.pop('symbol')
+    if action not in NOT_FOUND_MESSAGES:
+        return
+    obj = find_trade(session, model_class, action, params)
+    if not obj:
+        logger.debug(f'{NOT_FOUND_MESSAGES[action]} for {params["symbol"]}, trade_id: {params["trade_id"]}')
+        return
+    symbol = params.pop('symbol')
+    if action == 'status_closed':
         params['position_status'] = 'CLOSED'
-        # del params['trade_id']
-
-        for k, v in params.items():
-            setattr(obj, k, v)
+    else:
+        del params['trade_id']
 
-        obj.commit_changes()
+    for k, v in params.items():
+        setattr(obj, k, v)
+    if action == 'status_closed':
         logger.debug(f'Previous position modified to CLOSED for {symbol} for action: {action}')
+    else:
+        logger.debug(f'Trade modified for {symbol} for action: {action}')
+
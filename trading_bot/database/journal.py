@@ -0,0 +1,139 @@
+import atexit
+import queue
+import threading
+import time
+
+from sqlalchemy import text
+
+from trading_bot.database.db import Session
+from trading_bot.database.db_handler import apply_trade
+from trading_bot.settings import logger
+
+"""
+Write-behind journal for trade messages, the trading loop only puts messages on a queue and a background thread
+writes them to the db in batches. In crash safe mode every message is committed on the caller's thread before
+save_trade returns instead.
+"""
+
+_STOP = object()
+
+
+class TradeJournal:
+    def __init__(self, model_class, flush_interval=0.1, batch_size=100, crash_safe=False):
+        self.model_class = model_class
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.crash_safe = crash_safe
+        self.queue = queue.Queue()
+        self.closed = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        if not crash_safe:
+            self._thread = threading.Thread(target=self._run, name='trade-journal', daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def save_trade(self, action, params):
+        if self.crash_safe:
+            with self._write_lock:
+                self._write([(action, dict(params))])
+            return
+        if self.closed:
+            logger.debug(f'Journal closed, writing {action} for {params.get("symbol")} directly')
+            self._write([(action, dict(params))])
+            return
+        self.queue.put((action, dict(params)))
+
+    def flush(self):
+        """
+        Block till every message queued so far is committed
+        """
+        if not self.closed:
+            self.queue.join()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self._thread is not None:
+            self.queue.put(_STOP)
+            self._thread.join()
+        logger.debug('Trade journal flushed and closed')
+
+    @staticmethod
+    def coalesce(messages):
+        # Back to back updates of the same action for a trade (e.g. trailed stop losses) only need the last values,
+        # make_entry is never merged since it inserts the row
+        merged = []
+        last = dict()
+        for action, params in messages:
+            trade_id = params.get('trade_id')
+            i = last.get(trade_id)
+            if i is not None and action != 'make_entry' and merged[i][0] == action:
+                merged[i][1].update(params)
+                continue
+            last[trade_id] = len(merged)
+            merged.append((action, params))
+        return merged
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while batch[-1] is not _STOP and len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            stop = batch[-1] is _STOP
+            messages = batch[:-1] if stop else batch
+            try:
+                if messages:
+                    self._write(self.coalesce(messages))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _session(self):
+        session = Session()
+        if self.crash_safe:
+            # NORMAL sync (set on connect) can lose the last commits on power loss in WAL mode, FULL fsyncs every one
+            session.execute(text('PRAGMA synchronous=FULL'))
+        return session
+
+    def _write(self, messages):
+        session = self._session()
+        try:
+            for action, params in messages:
+                apply_trade(session, self.model_class, action, params)
+            session.commit()
+            return
+        except Exception as e:
+            logger.exception(e)
+            session.rollback()
+        finally:
+            session.close()
+
+        # One bad message should not lose the whole batch, retry them one at a time
+        logger.debug(f'Batch of {len(messages)} trade messages failed, retrying one by one')
+        for action, params in messages:
+            session = self._session()
+            try:
+                apply_trade(session, self.model_class, action, params)
+                session.commit()
+            except Exception as e:
+                logger.exception(e)
+                session.rollback()
+            finally:
+                session.close()
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import func, or_
+
+from trading_bot.database.db import Session, OptTradesData
+
+"""
+Startup queries, filtered/aggregated in sqlite so the whole trade table is never loaded
+"""
+
+
+def daily_realized_pnl(trading_mode, day):
+    """
+    Realized pnl of the positions closed on day (option lots of 100)
+    """
+    start = datetime(day.year, day.month, day.day)
+    pnl = (OptTradesData.exit_price - OptTradesData.entry_price) * OptTradesData.quantity * 100
+    session = Session()
+    try:
+        value = session.query(func.coalesce(func.sum(pnl), 0)).filter(
+            func.upper(OptTradesData.trading_mode) == trading_mode.upper(),
+            OptTradesData.position_status == 'CLOSED',
+            OptTradesData.exit_time >= start, OptTradesData.exit_time < start + timedelta(days=1)).scalar()
+    finally:
+        session.close()
+    return float(value)
+
+
+def open_trades(trading_mode):
+    """
+    OPEN positions and OPEN entry orders as plain dicts, decimals converted to float
+    """
+    columns = OptTradesData.__table__.columns
+    session = Session()
+    try:
+        rows = session.query(*columns).filter(
+            func.upper(OptTradesData.trading_mode) == trading_mode.upper(),
+            or_(OptTradesData.position_status == 'OPEN', OptTradesData.entry_order_status == 'OPEN')).all()
+    finally:
+        session.close()
+    return [{k: float(v) if isinstance(v, Decimal) else v for k, v in row._asdict().items()} for row in rows]
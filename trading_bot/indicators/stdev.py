@@ -0,0 +1,65 @@
+import math
+from collections import deque
+
+
+class RollingStd:
+    """
+    Rolling standard deviation over the last `length` bars, updated one bar at a time. Defaults match pandas-ta's
+    stdev (length 30, ddof 1, NaN until the window is full). A bar with the same timestamp as the last one replaces
+    it, as IB resends the bar in progress.
+    """
+
+    def __init__(self, length=30, ddof=1):
+        self.length = length
+        self.ddof = ddof
+        self.values = deque(maxlen=length)
+        self.last_ts = None
+        # Sums are kept relative to `ref` and rebuilt from the window every `length` bars so they can't drift
+        self.ref = 0.0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.bars_since_refresh = 0
+        self.std = math.nan
+
+    def update(self, ts, value):
+        if self.last_ts is not None and ts < self.last_ts:
+            return self.std
+
+        value = float(value)
+        if ts == self.last_ts:
+            self._remove(self.values[-1])
+            self.values[-1] = value
+        else:
+            if len(self.values) == self.length:
+                self._remove(self.values[0])
+            self.values.append(value)
+            self.bars_since_refresh += 1
+        self._add(value)
+        self.last_ts = ts
+
+        if self.bars_since_refresh >= self.length:
+            self._refresh()
+
+        n = len(self.values)
+        if n < self.length:
+            self.std = math.nan
+        else:
+            self.std = math.sqrt(max((self.sumsq - self.sum * self.sum / n) / (n - self.ddof), 0.0))
+        return self.std
+
+    def _add(self, value):
+        value -= self.ref
+        self.sum += value
+        self.sumsq += value * value
+
+    def _remove(self, value):
+        value -= self.ref
+        self.sum -= value
+        self.sumsq -= value * value
+
+    def _refresh(self):
+        self.ref = self.values[-1]
+        self.sum, self.sumsq = 0.0, 0.0
+        for value in self.values:
+            self._add(value)
+        self.bars_since_refresh = 0
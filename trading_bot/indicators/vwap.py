@@ -0,0 +1,111 @@
+import math
+from datetime import time
+
+import numpy as np
+
+
+class SessionVwap:
+    """
+    Streaming VWAP that resets at every session (calendar day of the bar timestamp), same as pandas-ta's
+    default 'D' anchor. IB resends the bar in progress on every update, so a bar with the same timestamp as the
+    last one replaces that bar's contribution instead of being added again.
+
+    Also keeps the population standard deviation of the session's per-bar VWAP values (the 'custom' band
+    width), which is only defined for bars between BANDS_START and BANDS_END like the original calculation.
+    """
+    BANDS_START = time(hour=9, minute=31)
+    BANDS_END = time(hour=16, minute=0)
+
+    def __init__(self):
+        self.session = None
+        self.last_ts = None
+        self.closed_pv = 0.0
+        self.closed_volume = 0.0
+        self.bar_pv = 0.0
+        self.bar_volume = 0.0
+        self.vwap = math.nan
+
+        # Closed bars' vwap values, offset by the session's first vwap to keep the sums well conditioned
+        self.path_ref = None
+        self.path_n = 0
+        self.path_sum = 0.0
+        self.path_sumsq = 0.0
+        self.std = math.nan
+
+    def update(self, ts, high, low, close, volume):
+        session = ts.date()
+        if session != self.session:
+            self.session = session
+            self.last_ts = None
+            self.closed_pv, self.closed_volume = 0.0, 0.0
+            self.bar_pv, self.bar_volume = 0.0, 0.0
+            self.path_ref, self.path_n, self.path_sum, self.path_sumsq = None, 0, 0.0, 0.0
+        elif self.last_ts is not None and ts < self.last_ts:
+            return self.vwap
+        elif ts != self.last_ts:
+            self.closed_pv += self.bar_pv
+            self.closed_volume += self.bar_volume
+            self._close_path_value(self.vwap)
+
+        volume = float(volume)
+        self.bar_pv = ((high + low + close) / 3) * volume
+        self.bar_volume = volume
+        self.last_ts = ts
+
+        cum_volume = self.closed_volume + self.bar_volume
+        vwap = (self.closed_pv + self.bar_pv) / cum_volume if cum_volume else math.nan
+        self.std = self._path_std(vwap) if self.BANDS_START <= ts.time() <= self.BANDS_END else math.nan
+        self.vwap = vwap
+        return vwap
+
+    def _close_path_value(self, value):
+        if math.isnan(value):
+            return
+        if self.path_ref is None:
+            self.path_ref = value
+        value -= self.path_ref
+        self.path_n += 1
+        self.path_sum += value
+        self.path_sumsq += value * value
+
+    def _path_std(self, vwap):
+        if math.isnan(vwap):
+            return math.nan
+        ref = vwap if self.path_ref is None else self.path_ref
+        value = vwap - ref
+        n = self.path_n + 1
+        mean = (self.path_sum + value) / n
+        return math.sqrt(max((self.path_sumsq + value * value) / n - mean * mean, 0.0))
+
+
+def session_vwap(df):
+    """
+    Vectorized session VWAP of a bar frame indexed by timestamp, same values as SessionVwap.
+    """
+    day = df.index.normalize()
+    volume = df['volume'].astype(float)
+    pv = ((df['high'] + df['low'] + df['close']) / 3) * volume
+    return pv.groupby(day).cumsum() / volume.groupby(day).cumsum().replace(0, np.nan)
+
+
+def vwap_bands(df, key='vwap', multiplier=2):
+    """
+    Expanding (per session) population std of the vwap column and the bands around it, for the whole frame at
+    once. Writes STD_VWAP, UPPER_VWAP and LOWER_VWAP, which are NaN outside the band window.
+    """
+    day = df.index.normalize()
+    values = df[key].astype(float)
+    offset = values - values.groupby(day).transform('first')
+    n = offset.groupby(day).cumcount() + 1
+    mean = offset.groupby(day).cumsum() / n
+    var = ((offset * offset).groupby(day).cumsum() / n - mean * mean).clip(lower=0)
+
+    minutes = df.index.hour * 60 + df.index.minute
+    start, end = SessionVwap.BANDS_START, SessionVwap.BANDS_END
+    in_window = (minutes >= start.hour * 60 + start.minute) & (minutes <= end.hour * 60 + end.minute)
+
+    std = np.sqrt(var).where(in_window)
+    df['STD_VWAP'] = std
+    df['UPPER_VWAP'] = values + (multiplier * std)
+    df['LOWER_VWAP'] = values - (multiplier * std)
+    return df
@@ -8,9 +8,11 @@ import pytz
 
 warnings.filterwarnings('ignore')
 
-BASE_DIR = Path(__file__).resolve().parent.parent
+# TRADING_BOT_BASE_DIR moves the db, logs and caches somewhere else, e.g. for the benchmarks
+BASE_DIR = Path(os.environ.get('TRADING_BOT_BASE_DIR', Path(__file__).resolve().parent.parent))
 LOGS_DIR = BASE_DIR / 'logs'
 RECORDS_DIR = BASE_DIR / 'records'
+CACHE_DIR = BASE_DIR / 'cache'
 TZ = pytz.timezone('US/Eastern')
 
 logger = logging.getLogger(__name__)
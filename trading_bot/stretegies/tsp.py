@@ -1,9 +1,6 @@
-import time as t
-from datetime import datetime, timedelta, time
-
-import dateutil.parser
-import pandas_ta as ta
+from datetime import datetime, timedelta
 
+from trading_bot.clients.events import EventDispatcher
 from trading_bot.settings import logger, TZ
 
 
@@ -39,47 +36,13 @@ class TSP:
                          above_vwap_std_per: {self.above_vwap_std_per}, 
                          standard_deviation multiplier: {self.standard_deviation}""")
 
+    def is_woken_by(self, events):
+        return (EventDispatcher.BAR, self.id_2) in events or (EventDispatcher.CHAIN, self.ticker) in events
+
     def print_more_logs(self, msg):
         if self.more_logs:
             logger.info(msg)
 
-    @staticmethod
-    def calculate_vwap_bands(df, curr_date, num_days):
-        key = 'vwap'
-
-        def stdev(df):
-            return df[key].values.std(ddof=0)
-
-        curr_position = datetime.combine(curr_date, time(hour=9, minute=31))
-        df.loc[str(curr_position), 'UPPER_VWAP'] = None
-        df.loc[str(curr_position), 'LOWER_VWAP'] = None
-        df.loc[str(curr_position), 'STD_VWAP'] = None
-        for _ in range(0, num_days):
-            day_data = df[curr_date == df.index.date].copy()
-            for _ in range(31, 60):
-                try:
-                    std = stdev(day_data[day_data.index.time <= curr_position.time()])
-                    df.loc[str(curr_position), 'UPPER_VWAP'] = df.loc[str(curr_position), key] + (2 * std)
-                    df.loc[str(curr_position), 'LOWER_VWAP'] = df.loc[str(curr_position), key] - (2 * std)
-                    df.loc[str(curr_position), 'STD_VWAP'] = std
-                except:
-                    pass
-                curr_position += timedelta(minutes=1)
-            for _ in range(10, 17):
-                while True:
-                    if curr_position.time() >= time(hour=16, minute=1):
-                        break
-                    std = stdev(day_data[day_data.index.time <= curr_position.time()])
-                    try:
-                        df.loc[str(curr_position), 'UPPER_VWAP'] = df.loc[str(curr_position), key] + (2 * std)
-                        df.loc[str(curr_position), 'LOWER_VWAP'] = df.loc[str(curr_position), key] - (2 * std)
-                        df.loc[str(curr_position), 'STD_VWAP'] = std
-                    except:
-                        pass
-                    curr_position += timedelta(minutes=1)
-            curr_position += timedelta(days=1)
-            curr_position = curr_position.replace(hour=9, minute=31)
-
     def run(self):
         if self.more_logs_time is None or datetime.now(tz=TZ) > self.more_logs_time:
             self.more_logs_time = datetime.now(tz=TZ) + timedelta(seconds=60)
@@ -89,49 +52,27 @@ class TSP:
         else:
             self.more_logs = False
 
-        if not len(self.client.data_frames[self.id_2]):
+        bars = self.client.bar_stores.get(self.id_2)
+        if bars is None or not len(bars):
             return
         if self.ticker not in self.client.secContract_details_end:
             return
 
-        df = self.client.data_frames[self.id_2]
         if self.today_open is None:
-            try:
-                today_data = df[df.index.date == datetime.now(tz=TZ).date()]
-            except ValueError as e:
-                return
-            if len(today_data):
-                self.today_open = today_data.iloc[0]['open']
-            else:
+            self.today_open = bars.session_open(datetime.now(tz=TZ).date())
+            if self.today_open is None:
                 return
 
-        try:
-            last_price = df.iloc[-1]['close']
-            df['volume'] = df['volume'].astype(int)
-            df['vwap'] = ta.vwap(high=df['high'], low=df['low'], close=df['close'], volume=df['volume'])
-            last_row = df.iloc[-1]
-        except ValueError:
-            return
-        except Exception as e:
-            logger.exception(e)
-            t.sleep(3)
-            return
+        last_price = float(bars.close[-1])
 
         # vwap strategy
-        vwap = last_row['vwap']
+        vwap_engine = self.client.vwaps[self.id_2]
+        vwap = vwap_engine.vwap
 
         if self.calc_method == 'pta':
-            vwap_std = ta.stdev(close=df['close'])
-            vwap_std = vwap_std.iloc[-1]
+            vwap_std = self.client.stdevs[self.id_2].std
         else:
-            try:
-                num_days = df.index.normalize().nunique()
-                self.calculate_vwap_bands(df=df, curr_date=datetime.now(tz=TZ).date(), num_days=num_days)
-                vwap_std = df['STD_VWAP'].iloc[-1]
-            except Exception as e:
-                logger.exception(e)
-                t.sleep(3)
-                return
+            vwap_std = vwap_engine.std
 
         if str(vwap).lower() == 'nan' or str(vwap_std).lower() == 'nan':
             return
@@ -177,37 +118,26 @@ class TSP:
         logger.info(f'{self.local_symbol}: vwap: {vwap}, vwap_std: {vwap_std}, vwap_below: {vwap_below}, '
                     f'vwap_std_val: {vwap_std_below}, final_value {final_value}, last_price : {last_price}')
 
-        try:
-            # Strike finding
-            expiries = sorted(self.client.contract_chain[self.ticker].keys())
-            req_date = datetime.now(tz=TZ) + timedelta(days=0)
-            expiries = sorted([dateutil.parser.parse(e).date() for e in expiries])
-            expiry_found = [e for e in expiries if e >= req_date.date()]
-            expiry_found = expiry_found[0].strftime('%Y%m%d')
-            strikes = sorted(self.client.contract_chain[self.ticker][expiry_found])
-        except Exception as e:
-            logger.exception(e)
+        # Strike finding
+        chain = self.client.option_chains.get(self.ticker)
+        expiry_found = chain.expiry_on_or_after(datetime.now(tz=TZ).date()) if chain is not None else None
+        if expiry_found is None:
+            logger.debug(f'{self.local_symbol}: no option expiry found on or after today')
+            return
+        strikes = chain.candidates(expiry_found, last_price)
+        if not len(strikes):
+            logger.debug(f'{self.local_symbol}: no whole dollar strike found for expiry {expiry_found}')
             return
-        found_strike = None
-        found_strike_index = None
-        minn = float('inf')
-        for i, strike in enumerate(sorted(strikes)):
-            strike = float(strike)
-            if strike % 1:
-                continue
-            if abs(strike - last_price) < minn:
-                found_strike = strike
-                found_strike_index = i
-                minn = abs(strike - last_price)
+        found_strike = float(strikes[0])
         logger.info(f'{self.local_symbol}: found_strike: {found_strike}')
 
         contract = self.client.make_contract(symbol=self.ticker, sec_type='OPT', exch=self.exch, curr=self.curr,
                                              opt_type=self.opt_type, expiry_date=str(expiry_found),
-                                             strike=float(found_strike))
+                                             strike=found_strike)
 
         # Iterating till not found valid strike, sometimes tws server gives wrong strikes from server,
         # so for avoiding that
-        for strike in sorted(strikes)[found_strike_index:]:
+        for strike in strikes:
             contract = self.client.make_contract(symbol=self.ticker, sec_type='OPT', exch=self.exch, curr=self.curr,
                                                  opt_type=self.opt_type, expiry_date=str(expiry_found),
                                                  strike=float(strike))
@@ -1,6 +1,7 @@
 import uuid
 from datetime import datetime
 
+from trading_bot.clients.events import EventDispatcher
 from trading_bot.settings import logger, TZ
 
 
@@ -9,7 +10,8 @@ class OptTradeManager:
                  trade_end_time, total_loss_amount, current_loss, side=None, entered=False, entry_order_filled=False,
                  exit_order_filled=False, bought=False, sold=False, instruction=None, qty=None, sl=None, final_sl=None,
                  trade_id=None, entry_order_id=None, entry_order_price=None, exit_pending=False,
-                 entry_order_status=None, exit_order_id=None, exit_order_price=None, entry_price=None, ref_price=None):
+                 entry_order_status=None, exit_order_id=None, exit_order_price=None, entry_price=None, ref_price=None,
+                 sl_order_type='STP', entry_order_type='MKT', exit_parent_id=None):
         self.ltp = None
         self.client = client
         self.id = unique_id
@@ -24,6 +26,8 @@ class OptTradeManager:
         self.opt_type = contract.right
         self.stop_loss = stop_loss
         self.tighter_stop_loss = tighter_stop_loss
+        self.sl_order_type = sl_order_type
+        self.entry_order_type = entry_order_type
         self.trade_end_time = trade_end_time
         self.total_loss_amount = total_loss_amount
         self.current_loss = current_loss
@@ -46,6 +50,7 @@ class OptTradeManager:
         self.exit_order_time = None
         self.exit_order_price = exit_order_price
         self.exit_order_id = exit_order_id
+        self.exit_parent_id = exit_parent_id
         self.exit_order_status = None
         self.exit_order_filled = exit_order_filled
         self.exit_pending = exit_pending
@@ -55,6 +60,7 @@ class OptTradeManager:
         self.position_status = None
         self.trade_ended = False
         self.ltp = None
+        self.tick_seq = 0
         self.position_check = True
         self.time_based_exit = False
         self.live_pnl = 0
@@ -72,14 +78,32 @@ class OptTradeManager:
     def __repr__(self):
         return f"trading_mode: {self.trading_mode}, id: {self.id}, instrument: {self.identifier}"
 
+    def is_woken_by(self, events):
+        # A filled position without a live exit order needs its stop placed right away, whatever the events
+        if self.entered and self.entry_order_filled and not self.exit_pending:
+            return True
+        if (EventDispatcher.TICK, self.id) in events:
+            return True
+        for order_id in (self.entry_order_id, self.exit_order_id):
+            if order_id is not None and ((EventDispatcher.ORDER, int(order_id)) in events or
+                                         (EventDispatcher.EXECUTION, int(order_id)) in events):
+                return True
+        return False
+
     def trade(self):
         if self.trade_ended:
             return self
 
         # Waiting for ltp of option
-        if self.id not in self.client.reqId_to_ltp:
+        tick = self.client.ticks.get(self.id)
+        if tick is None:
             return
-        self.ltp = self.client.reqId_to_ltp[self.id]
+        # Visits without a new tick (order events, heartbeat) skip the price driven work
+        new_tick = tick.seq != self.tick_seq
+        if new_tick:
+            self.tick_seq = tick.seq
+            self.ltp = tick.value
+            self.client.ticks.consumed(tick)
         if self.entered and self.entry_order_filled:
             self.live_pnl = (self.ltp - self.entry_price) * self.qty * 100
 
@@ -88,14 +112,17 @@ class OptTradeManager:
             self.make_entry()
         if self.entered and not self.entry_order_filled:
             self.confirm_entry()
-        if self.is_valid_exit():
-            self.make_exit()
-        if self.entered and self.exit_pending:
+        if self.entered and self.entry_order_filled and self.exit_pending:
             self.confirm_exit()
             if self.entered and self.exit_pending:
-                if not self.is_valid_time_based_exit() and not self.is_total_loss_based_exit():
+                if not self.is_valid_time_based_exit() and not self.is_total_loss_based_exit() and new_tick:
                     self.trail_sl()
-                self.confirm_exit()
+                    # STP trailing cancels the stop, pick up the cancel if it's confirmed already
+                    self.confirm_exit()
+        # After the exit checks, so a stop whose cancel was just confirmed is re-placed in the same visit instead of
+        # leaving the position without a stop until the next tick/heartbeat
+        if self.is_valid_exit():
+            self.make_exit()
 
         return {'msg': self.messages}
 
@@ -121,22 +148,52 @@ class OptTradeManager:
     def trail_sl(self):
         if not self.time_based_exit and self.ltp > self.ref_price:
             init_sl = self.final_sl
+            tightened = False
             final_sl = self.final_sl + (self.ltp - self.ref_price)
             if self.ltp >= (self.entry_price * (1 + 20 / 100)) > self.ref_price:
                 final_sl = self.ltp * (1 - (self.tighter_stop_loss / 100))
                 if final_sl > self.final_sl:
                     self.final_sl = final_sl
+                    tightened = True
                     logger.debug(f'{self.identifier}: SL trailed to {self.tighter_stop_loss}% after 20% move in price, '
                                  f'new sl: {self.final_sl}, before sl: {init_sl}, ltp: {self.ltp}')
             else:
                 self.final_sl = final_sl
-                logger.debug(f'{self.identifier}: SL trailed new sl: {self.final_sl}, before sl: {init_sl}, '
-                             f'ltp: {self.ltp}')
+                if self.sl_order_type != 'TRAIL':
+                    logger.debug(f'{self.identifier}: SL trailed new sl: {self.final_sl}, before sl: {init_sl}, '
+                                 f'ltp: {self.ltp}')
 
             self.ref_price = self.ltp
+            if self.sl_order_type == 'TRAIL':
+                # Broker trails the stop by the same amount itself, only the tighter stop needs an order modification
+                if tightened:
+                    self.modify_trailing_sl()
+                return
             self.client.cancelOrder(self.exit_order_id,
                                     str(datetime.now(tz=TZ).replace(microsecond=0, tzinfo=None)).replace('-', ''))
 
+    def modify_trailing_sl(self):
+        self.exit_order_price = float("{:0.2f}".format(self.final_sl))
+        # Same order id, so TWS modifies the resting order in place
+        self.client.placeOrder(self.exit_order_id, self.contract, self.make_sl_order(self.instruction))
+        logger.debug(f'{self.identifier}: Trailing SL order {self.exit_order_id} modified, '
+                     f'stop: {self.exit_order_price}, trail amount: {self.ref_price - self.final_sl}')
+        exit_data = self.save_trade(action='make_exit')
+        self.messages.append(exit_data)
+
+    def make_sl_order(self, action):
+        if self.sl_order_type == 'TRAIL':
+            trail_amount = float("{:0.2f}".format(self.ref_price - self.final_sl))
+            order = self.client.make_order(action=action, quantity=self.qty, order_type='TRAIL',
+                                           stop_price=self.exit_order_price, trail_amount=trail_amount)
+        else:
+            order = self.client.make_order(action=action, quantity=self.qty, order_type='STP',
+                                           stop_price=self.exit_order_price)
+        # Modifications of a bracket SL have to keep its parent
+        if self.exit_parent_id is not None:
+            order.parentId = self.exit_parent_id
+        return order
+
     def is_valid_entry(self):
         if self.entered:
             return False
@@ -162,11 +219,13 @@ class OptTradeManager:
             self.trade_ended = True
             return
 
-        self.client.nextorderId += 1
-        self.entry_order_id = self.client.nextorderId
-        self.client.placeOrder(self.entry_order_id, self.contract,
-                               self.client.make_order(self.instruction, self.qty,
-                                                      order_type='MKT'))
+        with self.client.ids.place_lock:
+            self.entry_order_id = self.client.ids.next_order_id()
+            entry_order = self.client.make_order(self.instruction, self.qty, order_type='MKT')
+            if self.entry_order_type == 'BRACKET':
+                self.place_bracket_entry(entry_order)
+            else:
+                self.client.placeOrder(self.entry_order_id, self.contract, entry_order)
         self.entry_order_time = datetime.now(tz=TZ)
         self.entered = True
         self.entry_order_filled = False
@@ -183,10 +242,32 @@ class OptTradeManager:
         entry_data = self.save_trade(action='make_entry')
         self.messages.append(entry_data)
 
+    def place_bracket_entry(self, entry_order):
+        # SL goes out as a child of the entry and is only transmitted with it, so it is live as soon as the entry
+        # fills; it is priced off the ltp here and moved to the actual fill price in confirm_entry. Runs with
+        # place_lock held by make_entry
+        self.exit_order_id = self.client.ids.next_order_id()
+        self.exit_parent_id = self.entry_order_id
+        self.ref_price = self.ltp
+        self.sl = self.final_sl = self.ltp * (1 - (self.stop_loss / 100))
+        self.exit_order_price = float("{:0.2f}".format(self.final_sl))
+        sl_order = self.make_sl_order('SELL' if self.instruction == 'BUY' else 'BUY')
+        entry_order.transmit = False
+        sl_order.transmit = True
+
+        self.client.placeOrder(self.entry_order_id, self.contract, entry_order)
+        self.client.placeOrder(self.exit_order_id, self.contract, sl_order)
+        self.exit_order_time = datetime.now(tz=TZ)
+        self.exit_order_status = 'OPEN'
+        self.exit_order_filled = False
+        self.exit_pending = True
+        logger.debug(f'{self.identifier}: Bracket SL order attached to entry, SL order price: {self.exit_order_price}, '
+                     f'SL order id: {self.exit_order_id}')
+
     def confirm_entry(self):
-        for exec_order in self.client.exec_orders:
-            if str(exec_order['exec_order_id']) == str(self.entry_order_id) and exec_order['symbol'] == self.symbol and \
-                    exec_order['exec_qty'] == self.qty:
+        exec_order = self.client.executions.get(int(self.entry_order_id))
+        if exec_order is not None:
+            if exec_order['symbol'] == self.symbol and exec_order['exec_qty'] == self.qty:
                 self.entry_price = self.ref_price = exec_order['exec_avg_price']
                 self.entry_time = exec_order['exec_time']
                 self.entry_order_filled = True
@@ -196,13 +277,19 @@ class OptTradeManager:
                 logger.debug(
                     f"{self.identifier}: Entry order Filled to {self.instruction}, price: {self.entry_price},"
                     f" qty:{self.qty}, time:{self.entry_time}, sl: {self.sl}")
+                if self.exit_pending:
+                    # Bracket SL is already live, move it from the ltp based price to the fill based one
+                    self.instruction = 'SELL' if self.bought else 'BUY'
+                    self.exit_order_price = float("{:0.2f}".format(self.final_sl))
+                    self.client.placeOrder(int(self.exit_order_id), self.contract, self.make_sl_order(self.instruction))
                 entry_data = self.save_trade(action='confirm_entry')
                 self.position_check = False
                 self.messages.append(entry_data)
                 return
 
-        for order in self.client.orders:
-            if str(order['order_id']) == str(self.entry_order_id) and order['status'] in ['Cancelled', 'Inactive']:
+        order = self.client.order_status.get(int(self.entry_order_id))
+        if order is not None:
+            if order['status'] in ['Cancelled', 'Inactive']:
                 logger.debug(f'{self.identifier} Entry order to {self.instruction} {order["status"]}')
                 self.entered = False
                 self.bought, self.sold = False, False
@@ -211,6 +298,10 @@ class OptTradeManager:
                 self.sl = None
                 self.entry_order_status = order['status']
                 self.position_status = None
+                if self.exit_pending:
+                    # Bracket SL child is cancelled along with its parent
+                    self.exit_pending = False
+                    self.exit_order_status = order['status']
 
                 entry_data = self.save_trade(action='confirm_entry')
                 self.messages.append(entry_data)
@@ -267,21 +358,19 @@ class OptTradeManager:
             logger.debug(f'{self.identifier}: Trade completed, closing instance')
 
     def make_exit(self):
-        self.client.nextorderId += 1
-        self.exit_order_id = self.client.nextorderId
-        self.client.nextorderId += 1
-
+        self.exit_parent_id = None
         self.exit_order_price = float("{:0.2f}".format(self.final_sl))
         if self.time_based_exit:
             price = 'MKT'
             order = self.client.make_order(action=self.instruction, quantity=self.qty, order_type='MKT')
         else:
             price = self.exit_order_price
-            order = self.client.make_order(action=self.instruction, quantity=self.qty, order_type='STP',
-                                           stop_price=self.exit_order_price)
+            order = self.make_sl_order(self.instruction)
 
         self.exit_order_time = datetime.now(tz=TZ)
-        self.client.placeOrder(self.exit_order_id, self.contract, order)
+        with self.client.ids.place_lock:
+            self.exit_order_id = self.client.ids.next_order_id()
+            self.client.placeOrder(self.exit_order_id, self.contract, order)
 
         self.exit_order_status = 'OPEN'
         self.exit_order_filled = False
@@ -293,13 +382,9 @@ class OptTradeManager:
         self.messages.append(exit_data)
 
     def confirm_exit(self):
-        for exec_order in self.client.exec_orders:
-            if exec_order['symbol'] != self.symbol:
-                continue
-            exec_order_id = str(exec_order['exec_order_id'])
-            if exec_order_id == str(self.exit_order_id):
-                if exec_order['exec_qty'] != self.qty:
-                    continue
+        exec_order = self.client.executions.get(int(self.exit_order_id))
+        if exec_order is not None and exec_order['symbol'] == self.symbol:
+            if exec_order['exec_qty'] == self.qty:
                 self.exit_price = exec_order['exec_avg_price']
                 self.exit_time = exec_order['exec_time']
                 self.exit_type = 'SL'
@@ -318,9 +403,9 @@ class OptTradeManager:
                 logger.debug(f'{self.identifier}: Trade completed, closing instance')
                 return
 
-        for order in self.client.orders:
-            order_id = str(order['order_id'])
-            if order_id == str(self.exit_order_id) and order['status'] in ['Cancelled', 'Inactive', 'ApiCancelled']:
+        order = self.client.order_status.get(int(self.exit_order_id))
+        if order is not None:
+            if order['status'] in ['Cancelled', 'Inactive', 'ApiCancelled']:
                 order_status = order['status']
                 logger.debug(f'{self.identifier} Exit order to {self.instruction}, status: {order_status}')
                 self.exit_pending = False
@@ -336,6 +421,11 @@ class OptTradeManager:
                                'quantity': self.qty, 'trade_id': self.trade_id, 'trading_mode': self.trading_mode,
                                'opt_type': self.opt_type, 'expiry_date': self.expiry_date,
                                'strike': self.strike, 'exchange': self.exchange}
+            if self.exit_pending:
+                message[action].update({'exit_order_id': self.exit_order_id, 'exit_order_time': self.exit_order_time,
+                                        'exit_order_price': self.exit_order_price,
+                                        'exit_order_status': self.exit_order_status, 'reference_price': self.ref_price,
+                                        'final_stop_loss': self.final_sl, 'exit_parent_id': self.exit_parent_id})
             return message
 
         elif action == 'confirm_entry':
@@ -343,13 +433,17 @@ class OptTradeManager:
                                'entry_price': self.entry_price, 'reference_price': self.ref_price,
                                'final_stop_loss': self.final_sl, 'entry_order_status': self.entry_order_status,
                                'position_status': self.position_status}
+            if self.exit_order_id is not None:
+                message[action].update({'instruction': self.instruction, 'exit_order_price': self.exit_order_price,
+                                        'exit_order_status': self.exit_order_status})
             return message
 
         elif action == 'make_exit':
             message[action] = {'symbol': self.symbol, 'trade_id': self.trade_id, 'instruction': self.instruction,
                                'exit_order_id': self.exit_order_id, 'exit_order_time': self.exit_order_time,
                                'exit_order_price': self.exit_order_price, 'exit_order_status': self.exit_order_status,
-                               'reference_price': self.ref_price, 'final_stop_loss': self.final_sl}
+                               'reference_price': self.ref_price, 'final_stop_loss': self.final_sl,
+                               'exit_parent_id': self.exit_parent_id}
             return message
 
         elif action == 'confirm_exit':